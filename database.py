@@ -1,7 +1,95 @@
 """Functions related to interacting with the databse should be placed here"""
 
-import sqlite3
+import json
+import os
 import re
+import sqlite3
+import threading
+import time
+import spatial
+
+META_SCHEMA = "meta" #sidecar database holding anything that isn't a round eg the stop index
+META_TABLES = [
+    """CREATE TABLE IF NOT EXISTS meta.addresses(id INTEGER PRIMARY KEY, street_key VARCHAR(255),
+    postcode_key VARCHAR(10), lat REAL, lon REAL, cell VARCHAR(12), osm_id VARCHAR(20),
+    UNIQUE(street_key, postcode_key));""",
+    "CREATE INDEX IF NOT EXISTS meta.addresses_cell ON addresses(cell);",
+    """CREATE TABLE IF NOT EXISTS meta.stops(round VARCHAR(255), street VARCHAR(255),
+    postcode VARCHAR(10), address_id INTEGER, rb INTEGER DEFAULT 0);""",
+    "CREATE INDEX IF NOT EXISTS meta.stops_round ON stops(round, rb);",
+    "CREATE INDEX IF NOT EXISTS meta.stops_address ON stops(address_id, rb);",
+    "CREATE TABLE IF NOT EXISTS meta.versions(round VARCHAR(255) PRIMARY KEY, version INTEGER);",
+    """CREATE TABLE IF NOT EXISTS meta.routes(round VARCHAR(255) PRIMARY KEY, version INTEGER,
+    route TEXT);""",
+    """CREATE TABLE IF NOT EXISTS meta.queue(round VARCHAR(255) PRIMARY KEY, priority INTEGER,
+    queued_at REAL);""",
+]
+NEAREST_LIMIT = 5 #number of rounds nearest_rounds returns by default
+UK_POSTCODE = re.compile(r"^[A-Z]{1,2}[0-9][A-Z0-9]?[0-9][A-Z]{2}$") #without its space
+OSM_ID = re.compile(r"^[NWR][0-9]+$") #nominatim /lookup format eg W123456 for a way
+
+#read-through cache of round contents shared by every connection in the process
+#db key -> {"tables": [names] or None, "schema_version": int, "rows": {table: (version, rows)}}
+round_caches = {}
+#id(connection) -> {"con": connection, "key": db key, "data_version": (main, meta)}
+#holds the connection itself so its id can't be reused by a new connection
+cache_connections = {}
+#guards both dicts above, request threads and the scheduler thread change them at once
+#held only while changing them, never over a query
+cache_lock = threading.Lock()
+
+def attach_meta(cur):
+    """attach the sidecar meta database (rounds.db -> rounds_meta.db) if it isn't already
+    kept in its own file so every table in the rounds database is still a round
+    must be called outside of a transaction, sqlite refuses to ATTACH inside one"""
+    databases = {db[1]: db[2] for db in cur.execute("PRAGMA database_list").fetchall()}
+    if META_SCHEMA in databases:
+        return
+
+    main_file = databases.get("main")
+    meta_file = f"{os.path.splitext(main_file)[0]}_meta.db" if main_file else ":memory:"
+    cur.execute(f"ATTACH DATABASE ? AS {META_SCHEMA}", (meta_file,))
+    for sql in META_TABLES:
+        cur.execute(sql)
+
+def round_cache(cur):
+    """get the round cache for cur's database, revalidating it if another connection committed
+    a commit from elsewhere (another worker, the scheduler) changes the connection's data_version,
+    only then are the stored round versions read back to drop the rounds that changed"""
+    con = cur.connection
+    memo = cache_connections.get(id(con))
+    if memo is None or memo["con"] is not con:
+        attach_meta(cur)
+        main_file = [db[2] for db in cur.execute("PRAGMA database_list").fetchall()
+                     if db[1] == "main"][0]
+        memo = {"con": con, "key": main_file or f":memory:{id(con)}", "data_version": None}
+        with cache_lock:
+            cache_connections[id(con)] = memo
+    with cache_lock:
+        cache = round_caches.setdefault(memo["key"], {"tables": None, "schema_version": None,
+                                                      "rows": {}})
+
+    data_version = (cur.execute("PRAGMA data_version").fetchone()[0],
+                    cur.execute("PRAGMA meta.data_version").fetchone()[0])
+    if data_version != memo["data_version"]:
+        memo["data_version"] = data_version
+        versions = dict(cur.execute("SELECT round, version FROM meta.versions").fetchall())
+        with cache_lock:
+            for table, (version, _) in list(cache["rows"].items()):
+                if versions.get(table) != version:
+                    cache["rows"].pop(table, None)
+
+    return cache
+
+def bump_version(table, cur):
+    """record a change to table so every worker's cache drops it, caller commits
+    call from anything that changes a round's contents/order or creates/drops it"""
+    cur.execute("""INSERT INTO meta.versions (round, version) VALUES (?, 1)
+    ON CONFLICT(round) DO UPDATE SET version=version+1;""", (table,))
+    cache = round_cache(cur)
+    with cache_lock:
+        cache["rows"].pop(table, None)
+        cache["tables"] = None
 
 def forbidden_char_check(street, postcode):
     """checks street and postcode vals for any established forbidden characters
@@ -14,8 +102,19 @@ def forbidden_char_check(street, postcode):
 
     return (True, None)
 
+def address_key(street, postcode):
+    """normalised (street, postcode) used to recognise the same address across rounds
+    case and runs of whitespace are ignored and UK postcodes are spaced as "AB1 2CD" """
+    street_key = " ".join(street.split()).upper()
+    postcode_key = "".join(postcode.split()).upper()
+    if UK_POSTCODE.match(postcode_key):
+        postcode_key = f"{postcode_key[:-3]} {postcode_key[-3:]}"
+    return (street_key, postcode_key)
+
 def rb_helper(table, cur):
-    """creates/overwrites the rollback for the table being modified"""
+    """creates/overwrites the rollback for the table being modified
+    the table's indexed stops are snapshotted alongside it"""
+    attach_meta(cur)
     all_table = [t[0] for t in cur.execute("SELECT name FROM sqlite_master").fetchall()]
 
     rb = f"{table}_rb"
@@ -28,6 +127,11 @@ def rb_helper(table, cur):
     else:
         cur.execute(sql_rb)
 
+    cur.execute("DELETE FROM meta.stops WHERE round=? AND rb=1;", (table,))
+    cur.execute("""INSERT INTO meta.stops (round, street, postcode, address_id, rb)
+    SELECT round, street, postcode, address_id, 1 FROM meta.stops WHERE round=? AND rb=0;""",
+    (table,))
+
 def table_verification(table):
     """verify inputted table is correctly formatted"""
 
@@ -78,21 +182,31 @@ def create_table(table, cur, con):
     if table in [t[0] for t in cur.execute("SELECT name FROM sqlite_master").fetchall()]:
         return (False, f"Table {table} already exists")
 
+    attach_meta(cur)
     creation = f"CREATE TABLE {table}(id INTEGER PRIMARY KEY, street VARCHAR(255), postcode VARCHAR(10));"
     cur.execute(creation)
+    bump_version(table, cur)
     con.commit()
     return (True, f"Table {table} created")
 
-def insert_value(table, street, postcode, cur, con):
-    """Insert street and postcode values into desired table, return status msg"""
+def insert_value(table, street, postcode, cur, con, osm_id=None):
+    """Insert street and postcode values into desired table, return status msg
+    osm_id eg "W123" pins the address to an OSM object, stored with the insert, see store_osm_id"""
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
 
     valid = verify_insert(table, street, postcode, cur)
     if valid[0] is False:
         return valid
+    if osm_id is not None:
+        #nothing is written for an invalid osm_id
+        valid = store_osm_id(street, postcode, osm_id, cur)
+        if valid[0] is False:
+            return valid
     rb_helper(table, cur)
 
     sql_in = f"INSERT INTO {table} (street, postcode) VALUES (?, ?)"
     cur.execute(sql_in, (street, postcode))
+    bump_version(table, cur)
     con.commit()
     return (True, f"Inserted values ({street}, {postcode}) into {table}")
 
@@ -106,6 +220,9 @@ def delete_value(table, street, postcode, cur, con):
 
     sql_del = f"DELETE FROM {table} WHERE street=? AND postcode=?;"
     cur.execute(sql_del, (street, postcode))
+    cur.execute("DELETE FROM meta.stops WHERE round=? AND rb=0 AND street=? AND postcode=?;",
+                (table, street, postcode))
+    bump_version(table, cur)
     con.commit()
     return (True, f"Deleted values ({street}, {postcode}) from {table}")
 
@@ -122,8 +239,13 @@ def delete_table(table, cur, con):
     sql_drop = f"DROP TABLE {table};"
     sql_drop_rb = f"DROP TABLE IF EXISTS {table}_rb;"
 
+    attach_meta(cur)
     cur.execute(sql_drop)
     cur.execute(sql_drop_rb)
+    cur.execute("DELETE FROM meta.stops WHERE round=?;", (table,))
+    cur.execute("DELETE FROM meta.routes WHERE round=?;", (table,))
+    cur.execute("DELETE FROM meta.queue WHERE round=?;", (table,))
+    bump_version(table, cur)
     con.commit()
     return (True, f"Table {table} and its rollback deleted")
 
@@ -147,14 +269,29 @@ def rollback_table(table, cur, con):
     CREATE TABLE {table} AS SELECT * FROM {rb};
     DROP TABLE {rb};
     """
+    attach_meta(cur)
     cur.executescript(sql_rollback)
+    #indexed stops follow the table back to its snapshot
+    cur.execute("DELETE FROM meta.stops WHERE round=? AND rb=0;", (table,))
+    cur.execute("UPDATE meta.stops SET rb=0 WHERE round=? AND rb=1;", (table,))
+    bump_version(table, cur)
     con.commit()
     return (True, f"Table {table} has been rolled back")
 
 def select_all(table, cur):
-    """get all (street, postcode) used when re-optimising table after deletion/insertion"""
+    """get all (street, postcode) used when re-optimising table after deletion/insertion
+    served from the round cache, the returned list is shared so don't modify it"""
+    cache = round_cache(cur)
+    cached = cache["rows"].get(table) #a single lookup, another thread may drop it after a check
+    if cached is not None:
+        return cached[1]
+
+    #version first - if the table changes in between, the cached rows are dropped next check
+    version = cur.execute("SELECT version FROM meta.versions WHERE round=?;", (table,)).fetchone()
     sql_select = f"SELECT street, postcode FROM {table}"
     output = cur.execute(sql_select).fetchall()
+    with cache_lock:
+        cache["rows"][table] = (version[0] if version else None, output)
 
     #output will look like [("1 House St", "A01"), ("2 House St", "A01"), ...]
     return output
@@ -168,23 +305,229 @@ def table_optimisation_update(table, new_add_order, cur):
     CREATE TABLE {table}(id INTEGER PRIMARY KEY, street VARCHAR(255), postcode VARCHAR(10));
     """
     cur.executescript(sql_setup)
+    attach_meta(cur)
 
-    for add in new_add_order:
-        cur.execute(f"INSERT INTO {table} (street, postcode) VALUES (?, ?);", (add[0], add[1]))
+    cur.executemany(f"INSERT INTO {table} (street, postcode) VALUES (?, ?);", new_add_order)
+    bump_version(table, cur)
 
 def get_all_tables(cur):
     """Get every table name & values to send to frontend
     return looks like {table: [(1 House St, A01), ...]}"""
     all_data = {}
 
-    all_table = [table[0] for table in cur.execute("SELECT name FROM sqlite_master").fetchall()]
-
-    for t in all_table:
+    cache = round_cache(cur)
+    #any create/drop, from this connection or another, changes the schema version
+    schema_version = cur.execute("PRAGMA schema_version").fetchone()[0]
+    tables = cache["tables"] #read once, another thread may reset it to None meanwhile
+    if tables is None or schema_version != cache["schema_version"]:
+        tables = [table[0] for table in cur.execute("SELECT name FROM sqlite_master").fetchall()]
+        with cache_lock:
+            cache["tables"] = tables
+            cache["schema_version"] = schema_version
+
+    for t in tables:
         if "_rb" in t:
             continue
-        sql_select = f"SELECT street, postcode FROM {t}"
-        output = cur.execute(sql_select).fetchall()
-
-        all_data[t] = output
+        all_data[t] = select_all(t, cur)
     
-    return all_data
\ No newline at end of file
+    return all_data
+
+def index_stops(table, stops, cur):
+    """Replace the indexed stops of a table with stops [(street, postcode, lat, lon), ...]
+    called once a round has been geocoded so the index matches its stored order"""
+    attach_meta(cur)
+    cur.execute("DELETE FROM meta.stops WHERE round=? AND rb=0;", (table,))
+
+    rows = []
+    for street, postcode, lat, lon in stops:
+        rows.append((table, street, postcode, store_geocode(street, postcode, lat, lon, cur)))
+
+    cur.executemany("""INSERT INTO meta.stops (round, street, postcode, address_id, rb)
+    VALUES (?, ?, ?, ?, 0);""", rows)
+
+def store_geocode(street, postcode, lat, lon, cur, osm_id=None):
+    """Record the geocode of an address in the table shared by every round, caller commits
+    osm_id is kept for /lookup and left as it is when not given
+    return the address id rounds' stops reference it by"""
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    lat, lon = float(lat), float(lon) #nominatim hands back coordinates as strings
+    street_key, postcode_key = address_key(street, postcode)
+    cur.execute("""INSERT INTO meta.addresses (street_key, postcode_key, lat, lon, cell, osm_id)
+    VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(street_key, postcode_key)
+    DO UPDATE SET lat=excluded.lat, lon=excluded.lon, cell=excluded.cell,
+    osm_id=COALESCE(excluded.osm_id, osm_id);""",
+    (street_key, postcode_key, lat, lon, spatial.encode(lat, lon), osm_id))
+    return cur.execute("SELECT id FROM meta.addresses WHERE street_key=? AND postcode_key=?;",
+                       (street_key, postcode_key)).fetchone()[0]
+
+def store_osm_id(street, postcode, osm_id, cur):
+    """Record the OSM object an address is, eg picked by the user from a nominatim search
+    a changed osm_id clears the stored geocode so the address is looked up again, caller commits
+    return a (False, msg) tuple for a badly formatted osm_id, (True, None) otherwise"""
+    if not isinstance(osm_id, str) or not OSM_ID.match(osm_id):
+        return (False, "Invalid OSM id. Please use N, W or R followed by the numeric id")
+
+    attach_meta(cur)
+    street_key, postcode_key = address_key(street, postcode)
+    cur.execute("""INSERT INTO meta.addresses (street_key, postcode_key, osm_id)
+    VALUES (?, ?, ?) ON CONFLICT(street_key, postcode_key)
+    DO UPDATE SET lat=CASE WHEN osm_id IS excluded.osm_id THEN lat END,
+    lon=CASE WHEN osm_id IS excluded.osm_id THEN lon END,
+    cell=CASE WHEN osm_id IS excluded.osm_id THEN cell END,
+    osm_id=excluded.osm_id;""", (street_key, postcode_key, osm_id))
+    return (True, None)
+
+def select_addresses(addresses, cur):
+    """get what is known about each (street, postcode) in addresses from the shared address table
+    output will look like [(51.5, -0.1, "W123"), (None, None, "N456"), None, ...]
+    lat/lon are None until geocoded, osm_id is None if unknown, None for unknown addresses"""
+    attach_meta(cur)
+    sql_select = """SELECT lat, lon, osm_id FROM meta.addresses
+    WHERE street_key=? AND postcode_key=?;"""
+    return [cur.execute(sql_select, address_key(street, postcode)).fetchone()
+            for street, postcode in addresses]
+
+def nearest_rounds(lat, lon, cur, limit=NEAREST_LIMIT):
+    """Find the rounds with a stop closest to lat/lon using the geohash stop index
+    searches the surrounding cells, widening them until limit rounds are found and every one
+    is within the distance the cells are sure to cover, so no closer round can be outside them
+    return looks like [(table, distance_km), ...] nearest first"""
+    attach_meta(cur)
+    lat, lon = float(lat), float(lon)
+
+    nearest = []
+    for precision in range(spatial.SEARCH_PRECISION, 0, -1):
+        candidates = select_cell_stops(spatial.neighbours(lat, lon, precision), cur)
+        if not candidates:
+            continue
+
+        closest = {}
+        for table, stop_lat, stop_lon in candidates:
+            distance = spatial.haversine(lat, lon, stop_lat, stop_lon)
+            if table not in closest or distance < closest[table]:
+                closest[table] = distance
+        nearest = sorted(closest.items(), key=lambda item: item[1])[:limit]
+        if len(nearest) == limit and nearest[-1][1] <= spatial.cover_radius(lat, precision):
+            break
+
+    return nearest
+
+def select_cell_stops(cells, cur):
+    """get the (table, lat, lon) of every indexed stop inside any of the geohash cells"""
+    #a prefix match is a range scan on the cell index, "~" sorts after every base32 char
+    clause = " OR ".join(["(cell >= ? AND cell < ?)"] * len(cells))
+    params = [bound for cell in cells for bound in (cell, f"{cell}~")]
+    sql_near = f"""SELECT s.round, a.lat, a.lon FROM meta.addresses a
+    JOIN meta.stops s ON s.address_id=a.id AND s.rb=0 WHERE {clause};"""
+    return cur.execute(sql_near, params).fetchall()
+
+def select_stops(table, cur):
+    """get all (street, postcode, lat, lon) in table order, lat/lon are None for unindexed stops
+    output will look like [("1 House St", "A01", 51.5, -0.1), ...]"""
+    attach_meta(cur)
+    sql_select = f"""SELECT t.street, t.postcode, a.lat, a.lon FROM {table} t
+    LEFT JOIN meta.stops s ON s.round=? AND s.rb=0 AND s.street=t.street AND s.postcode=t.postcode
+    LEFT JOIN meta.addresses a ON a.id=s.address_id
+    ORDER BY t.rowid;"""
+    return cur.execute(sql_select, (table,)).fetchall()
+
+def table_reorder(table, expected, new_add_order, cur):
+    """Rewrite the table in new_add_order, but only if it still holds expected in that order
+    used by background re-optimisation so it never overwrites an edit made since it read the table
+    caller commits, or rolls back on (False, msg) when the table has changed"""
+    cur.execute("BEGIN IMMEDIATE;") #hold the write lock between the check and the rewrite
+
+    if table not in [t[0] for t in cur.execute("SELECT name FROM sqlite_master").fetchall()]:
+        return (False, f"Table {table} does not exist")
+    #read the table itself rather than the cache, the check must see the latest commit
+    if cur.execute(f"SELECT street, postcode FROM {table}").fetchall() != list(expected):
+        return (False, f"Table {table} changed since it was read")
+
+    cur.execute(f"DELETE FROM {table};")
+    cur.executemany(f"INSERT INTO {table} (street, postcode) VALUES (?, ?);", new_add_order)
+    bump_version(table, cur)
+    return (True, f"Table {table} reordered")
+
+def create_rounds(new_rounds, cur, con, trips=None):
+    """Create several tables at once from new_rounds [(table, [(street, postcode, lat, lon), ...])]
+    trips optionally holds a valhalla trip per round, stored as its route, see store_route
+    every table, its stop index and route is written in one transaction, all of them or none
+    return status msg"""
+    all_table = [t[0] for t in cur.execute("SELECT name FROM sqlite_master").fetchall()]
+    for table, _ in new_rounds:
+        valid = table_verification(table)
+        if valid[0] is False:
+            return valid
+        if table in all_table:
+            return (False, f"Table {table} already exists")
+    if len({table for table, _ in new_rounds}) != len(new_rounds):
+        return (False, "Table names must be unique")
+
+    attach_meta(cur)
+    cur.execute("BEGIN;") #sqlite DDL is transactional once a transaction is explicitly open
+    try:
+        for i, (table, stops) in enumerate(new_rounds):
+            cur.execute(f"""CREATE TABLE {table}(id INTEGER PRIMARY KEY, street VARCHAR(255),
+            postcode VARCHAR(10));""")
+            cur.executemany(f"INSERT INTO {table} (street, postcode) VALUES (?, ?);",
+                            [stop[:2] for stop in stops])
+            index_stops(table, stops, cur)
+            bump_version(table, cur)
+            if trips is not None:
+                store_route(table, trips[i], cur)
+    except Exception:
+        #a bad trip as well as a failed write must leave none of the rounds behind
+        con.rollback()
+        raise
+    con.commit()
+
+    tables = ", ".join(table for table, _ in new_rounds)
+    return (True, f"Tables {tables} created")
+
+def store_route(table, trip, cur):
+    """Store the summary and each leg's summary and encoded shape of a valhalla trip through table
+    tied to the table's current version so any later change to the table invalidates it
+    caller commits, return the stored route"""
+    stored = {
+        "summary": trip["summary"],
+        "legs": [{"summary": leg["summary"], "shape": leg["shape"]} for leg in trip["legs"]],
+    }
+    version = cur.execute("SELECT version FROM meta.versions WHERE round=?;", (table,)).fetchone()
+    cur.execute("INSERT OR REPLACE INTO meta.routes (round, version, route) VALUES (?, ?, ?);",
+                (table, version[0] if version else None, json.dumps(stored)))
+    return stored
+
+def select_route(table, cur):
+    """get the stored route through table, None if there isn't one or the table has changed since"""
+    attach_meta(cur)
+    sql_route = """SELECT r.route FROM meta.routes r LEFT JOIN meta.versions v ON v.round=r.round
+    WHERE r.round=? AND r.version IS v.version;"""
+    output = cur.execute(sql_route, (table,)).fetchone()
+    return json.loads(output[0]) if output else None
+
+def enqueue_round(table, priority, cur):
+    """Queue a round for the background scheduler, shared by every worker through meta.queue
+    an already queued round keeps the best (lowest) priority, caller commits"""
+    attach_meta(cur)
+    cur.execute("""INSERT INTO meta.queue (round, priority, queued_at) VALUES (?, ?, ?)
+    ON CONFLICT(round) DO UPDATE SET priority=MIN(priority, excluded.priority);""",
+    (table, priority, time.time()))
+
+def enqueue_rounds(priority, cur):
+    """Queue every round not already queued at priority, caller commits"""
+    attach_meta(cur)
+    tables = [(t[0], priority, time.time()) for t in
+              cur.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+              if "_rb" not in t[0]]
+    cur.executemany("""INSERT INTO meta.queue (round, priority, queued_at) VALUES (?, ?, ?)
+    ON CONFLICT(round) DO NOTHING;""", tables)
+
+def pop_round(cur):
+    """Take the best priority, longest queued round off meta.queue, caller commits
+    return (table, priority) or None if nothing is queued"""
+    attach_meta(cur)
+    item = cur.execute("""SELECT round, priority FROM meta.queue
+    ORDER BY priority, queued_at LIMIT 1;""").fetchone()
+    if item is not None:
+        cur.execute("DELETE FROM meta.queue WHERE round=?;", (item[0],))
+    return item
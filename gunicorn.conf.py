@@ -0,0 +1,42 @@
+"""Gunicorn settings for running wsgi:app in production, every value can be set from the environment
+WORKERS, BIND, TIMEOUT, GRACEFUL_TIMEOUT - server settings
+DB_PATH, GEO_URL, ROUTE_URL, MATRIX_URL - read by main.py, nominatim.py and valhalla.py
+PROFILE_RATE, PROFILE_TOKEN, PROFILE_DIR - opt-in request profiling, read by profiler.py"""
+
+#gunicorn reads its settings from these lowercase names
+# pylint: disable=invalid-name
+
+import fcntl
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "sync" #one request per process at a time, sqlite connections are per process
+timeout = int(os.environ.get("TIMEOUT", 120)) #optimising a large round can take a while
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+preload_app = True #import the app once in the master, workers fork from it
+
+SCHEDULER_LOCK = f"{os.environ.get('DB_PATH', 'rounds.db')}.scheduler.lock"
+scheduler_lock = None
+
+def post_fork(server, worker): # pylint: disable=unused-argument
+    """give each worker its own connections and start the scheduler in exactly one of them
+    the worker holding the lock file runs it, if it dies the lock frees for the next worker"""
+    global scheduler_lock # pylint: disable=global-statement
+    import main # pylint: disable=import-outside-toplevel
+
+    scheduler_lock = open(SCHEDULER_LOCK, "w", encoding="utf-8") # pylint: disable=consider-using-with
+    try:
+        fcntl.flock(scheduler_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        run_scheduler = True
+    except OSError:
+        scheduler_lock.close()
+        run_scheduler = False
+
+    main.init_worker(run_scheduler)
+
+def worker_exit(server, worker): # pylint: disable=unused-argument
+    """graceful shutdown of a worker, replaces the old atexit hook"""
+    import main # pylint: disable=import-outside-toplevel
+    main.shutdown(graceful_timeout)
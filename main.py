@@ -1,49 +1,265 @@
 """Main.py is responsible for handling requests via Flask 
 and calling functions from other modules to satisfy the requests"""
 
+import os
 import sqlite3
-import atexit
-from flask import Flask, request
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from flask import Blueprint, Flask, request
 import nominatim as n
 import valhalla as v
 import database as d
-app = Flask(__name__)
+import profiler as p
+import rounds as r
+import scheduler as s
+bp = Blueprint("rounds", __name__)
 
-DB_PATH = "rounds.db"
+DB_PATH = os.environ.get("DB_PATH", "rounds.db")
 VALID_STATE = 0 # True or False
 VALID_RETURN = 1 #postion of returned content eg a message, a list
+SPLIT_WORKERS = 8 #most sub-rounds /split_round optimises at once
+
+#quality tiers of an order, reported in the X-Optimisation-Tier response header
+OPTIMISED = "optimised" #valhalla's optimised order
+HEURISTIC = "heuristic" #straight line order found locally, valhalla didn't answer in time
+STORED = "stored" #order left as stored/requested, geocoding didn't finish in time
+TIER_HEADER = "X-Optimisation-Tier"
+HEURISTIC_SHARE = 0.2 #share of a latency budget spent improving the heuristic order
+WARM_UP_TIMEOUT = 2 #seconds to wait for an engine's status when a worker starts
 
 con = None
+#background re-optimisation, only started in one worker
+scheduler = None # pylint: disable=invalid-name
+#set by init_worker, rounds are only queued for the scheduler when serving
+serving = False # pylint: disable=invalid-name
 
 def get_con():
     """lazy instantiation of db connection"""
     global con
     if con is not None:
         return
-    con = sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(DB_PATH, factory=p.connection_factory())
+    d.attach_meta(con.cursor())
     return con
 
 def close_con():
-    """Connection closer for atexit to call"""
+    """Close the db connection if one is open"""
+    global con # pylint: disable=global-statement
+    if con is None:
+        return
     con.close()
+    con = None
+
+def warm_up(session, url):
+    """Reconnect an engine's session and open a connection ahead of the first request
+    connections opened before a fork mustn't be shared between workers
+    return True if the engine answered at its status url"""
+    session.close() #the session opens new connections on its next request
+    try:
+        session.get(url, timeout=WARM_UP_TIMEOUT)
+    except requests.RequestException:
+        return False
+    return True
+
+def init_worker(run_scheduler=False):
+    """Set up the per process state of a server worker
+    drops anything inherited through a fork, reconnects to the engines
+    and starts the background scheduler if this process is the one running it
+    the db connection is left to get_con so it opens on the thread serving requests"""
+    global con, scheduler, serving # pylint: disable=global-statement
+    con = None #never share a sqlite connection opened before the fork
+    serving = True
+    warm_up(n.session, n.STATUS_URL)
+    warm_up(v.session, v.STATUS_URL)
+
+    if run_scheduler:
+        scheduler = s.Scheduler(DB_PATH)
+        scheduler.start()
+
+def shutdown(timeout=None):
+    """Graceful shutdown - let the scheduler finish its current round, then close the db"""
+    global scheduler # pylint: disable=global-statement
+    if scheduler is not None:
+        scheduler.stop(timeout)
+        scheduler = None
+    close_con()
+
+def create_app():
+    """App factory, the same app serves the dev server, tests and the WSGI entry point"""
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(bp)
+    return flask_app
+
+@bp.before_app_request
+def record_activity():
+    """Let the scheduler, in whichever worker runs it, know the service is busy
+    so background work waits"""
+    if serving:
+        s.touch(DB_PATH)
+
+@bp.before_app_request
+def start_profile():
+    """Profile the request if it's sampled or asks to be, see profiler.py"""
+    if p.enabled():
+        p.start(request.headers.get(p.PROFILE_HEADER))
+
+@bp.teardown_app_request
+def stop_profile(exc=None): # pylint: disable=unused-argument
+    """Write the request's profile, runs even if the request raised"""
+    if p.active():
+        p.stop(request.endpoint or request.path)
+
+def schedule(table):
+    """Queue a round for background re-optimisation in the queue shared by every worker"""
+    if serving:
+        get_con()
+        cur = con.cursor()
+        d.enqueue_round(table, s.EDITED, cur)
+        con.commit()
+        cur.close()
 
-atexit.register(close_con)
-
-@app.route('/optimise', methods=["POST"])
+@bp.route('/optimise', methods=["POST"])
 def optimise_addresses(addresses=None):
-    """Process the the requests addresses and return JSON of the addresses in optimised order"""
+    """Process the the requests addresses and return JSON of the addresses in optimised order
+    addresses may also be a rounds.Round, which is geocoded in place
+    optional "budget_ms" in the request bounds the time taken, see optimise_within"""
     if not addresses:
         request_data = request.get_json()
         addresses = request_data['addresses']
+        if request_data.get('budget_ms') is not None:
+            return optimise_within(addresses, request_data['budget_ms'])
+
+    if isinstance(addresses, r.Round):
+        geos = n.geocode_round(addresses, cur=con.cursor())
+        if geos[VALID_STATE] is False:
+            return f"Issue with geocoding address: {geos[VALID_RETURN]}"
+        #keep the whole trip so its legs can be stored with the new order
+        addresses.trip = v.optimise_trip(addresses.locations())
+        return addresses.trip['locations']
 
     geos = n.geocode_adds(addresses)
-    if geos[VALID_STATE] == False:
+    if geos[VALID_STATE] is False:
         return f"Issue with geocoding address: {geos[VALID_RETURN]}"
 
     opt_adds = v.optimise_adds(geos[VALID_RETURN])
     return opt_adds
 
-@app.route('/create_table', methods=["POST"])
+def anytime_order(coords, deadline):
+    """Best order of geocoded coords that can be found before the time.monotonic() deadline
+    a heuristic order is found first, then valhalla gets whatever time is left to beat it
+    return (tier, order, trip) - trip is valhalla's trip for the order or None"""
+    if len(coords) < 2:
+        #nothing to order, and valhalla can't make a trip from fewer than two locations
+        return (OPTIMISED, np.arange(len(coords)), None)
+    now = time.monotonic()
+    order = r.heuristic_order(coords, now + max(deadline - now, 0) * HEURISTIC_SHARE)
+
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        return (HEURISTIC, order, None)
+    try:
+        trip = v.optimise_trip([{"lat": lat, "lon": lon} for lat, lon in coords[order].tolist()],
+                               timeout=timeout)
+    except requests.Timeout:
+        return (HEURISTIC, order, None)
+
+    #original_index refers to the heuristic order that was sent
+    optimised = order[[loc["original_index"] for loc in trip["locations"]]]
+    return (OPTIMISED, optimised, trip)
+
+def optimise_within(addresses, budget_ms):
+    """/optimise within budget_ms, returning the best order reached and its tier in the header
+    when geocoding doesn't finish in time the addresses come back in request order without
+    coordinates [ {"original_index": int}, ...]"""
+    deadline = time.monotonic() + budget_ms / 1000
+    try:
+        geos = n.geocode_adds(addresses, deadline)
+    except requests.Timeout:
+        return [{"original_index": i} for i in range(len(addresses))], 200, {TIER_HEADER: STORED}
+    if geos[VALID_STATE] is False:
+        return f"Issue with geocoding address: {geos[VALID_RETURN]}"
+
+    coords = np.array([[float(geo["lat"]), float(geo["lon"])] for geo in geos[VALID_RETURN]])
+    tier, order, _ = anytime_order(coords, deadline)
+    opt_adds = [{"lat": coords[i][0], "lon": coords[i][1], "original_index": i}
+                for i in order.tolist()]
+    return opt_adds, 200, {TIER_HEADER: tier}
+
+def reoptimise_within(table, cur, budget_ms):
+    """reoptimise_table within budget_ms, storing the best order reached
+    rounds left short of valhalla's order are queued for the background scheduler
+    stored coordinates are reused so only new stops are geocoded"""
+    deadline = time.monotonic() + budget_ms / 1000
+    rnd = r.Round.from_stops(table, d.select_stops(table, cur))
+    try:
+        geos = n.geocode_round(rnd, deadline, cur)
+    except requests.Timeout:
+        schedule(table)
+        return (True, STORED)
+    if geos[VALID_STATE] is False:
+        return (False, f"Issue with geocoding address: {geos[VALID_RETURN]}")
+
+    tier, order, trip = anytime_order(rnd.coords, deadline)
+    rnd.reorder(order)
+    rnd.trip = trip
+
+    d.table_optimisation_update(table, rnd.rows(), cur)
+    d.index_stops(table, rnd.stops(), cur)
+    if rnd.trip is not None:
+        d.store_route(table, rnd.trip, cur)
+    con.commit()
+    if tier != OPTIMISED:
+        schedule(table)
+    return (True, tier)
+
+def reoptimise_table(table, cur, budget_ms=None):
+    """Re-optimise a table after an insert/delete, storing the new order and its stop index
+    return a (False, msg) tuple if geocoding failed, (True, tier) otherwise
+    budget_ms bounds the time taken, see reoptimise_within"""
+    if budget_ms is not None:
+        return reoptimise_within(table, cur, budget_ms)
+    rnd = r.Round.from_rows(table, d.select_all(table, cur))
+
+    opt_adds = optimise_addresses(rnd)
+    if isinstance(opt_adds, str):
+        return (False, opt_adds)
+    rnd.apply_trip(opt_adds)
+
+    d.table_optimisation_update(table, rnd.rows(), cur)
+    d.index_stops(table, rnd.stops(), cur)
+    if rnd.trip is not None:
+        d.store_route(table, rnd.trip, cur)
+    con.commit()
+    return (True, OPTIMISED)
+
+def quick_insert(table, street, postcode, cur):
+    """Place a newly inserted stop into the stored order at its cheapest straight line position
+    and queue the round for background re-optimisation
+    when the rest of the round has no stored coordinates the stop stays where it was appended,
+    the scheduler geocodes and orders the round rather than this request"""
+    stops = [stop for stop in d.select_stops(table, cur) if stop[:2] != (street, postcode)]
+    rnd = r.Round.from_stops(table, stops)
+    if not rnd.geocoded():
+        con.commit()
+        schedule(table)
+        return (True, STORED)
+
+    new = r.Round.from_rows(table, [(street, postcode)])
+    geos = n.geocode_round(new, cur=cur)
+    if geos[VALID_STATE] is False:
+        return (False, f"Issue with geocoding address: {geos[VALID_RETURN]}")
+    lat, lon = new.coords[0].tolist()
+
+    rnd.insert(rnd.insertion_index(lat, lon), street, postcode, lat, lon)
+    d.table_optimisation_update(table, rnd.rows(), cur)
+    d.index_stops(table, rnd.stops(), cur)
+    con.commit()
+    schedule(table)
+    return (True, HEURISTIC)
+
+@bp.route('/create_table', methods=["POST"])
 def create_table():
     """Receive {"table": string} and see if a table in the db can be created
     return a success/fail msg"""
@@ -56,7 +272,7 @@ def create_table():
     cur.close()
     return valid[VALID_RETURN]
 
-@app.route('/delete_table', methods=["POST"])
+@bp.route('/delete_table', methods=["POST"])
 def delete_table():
     """Receive {"table": string} and see if a table in the db can be deleted
     return a success/fail msg"""
@@ -69,47 +285,47 @@ def delete_table():
     cur.close()
     return valid[VALID_RETURN]
 
-@app.route('/insert_value', methods=["POST"])
+@bp.route('/insert_value', methods=["POST"])
 def insert_value():
     """Receive {"table": string, "address": (street, postcode)} 
-    and see if it can be inserted to db, return a success/fail msg"""
+    and see if it can be inserted to db, return a success/fail msg
+    optional "defer": true stores a quick heuristic order and re-optimises in the background
+    optional "budget_ms" bounds the time spent optimising
+    optional "osm_id" eg "W123" pins the address to an OSM object so it is geocoded by /lookup
+    the X-Optimisation-Tier header says how well the stored order was optimised"""
     get_con()
     cur = con.cursor()
 
     request_data = request.get_json()
     table = request_data['table']
     address = request_data['address'] #(street, postcode)
-    valid = d.insert_value(table, address[0], address[1], cur, con)
+    valid = d.insert_value(table, address[0], address[1], cur, con, request_data.get('osm_id'))
 
     if valid[VALID_STATE] is False:
         #something wrong with input return the error message so no work wasted
+        con.rollback()
         cur.close()
         return valid[VALID_RETURN]
 
-    select_table = d.select_all(table, cur)
-    addresses = []
-    for result in select_table:
-        addresses.append({"q": f"{result[0]} {result[1]}", "format": "json"})
-
-    opt_adds = optimise_addresses(addresses)
-    if opt_adds[VALID_STATE] == False:
-        return f"Issue with geocoding address: {opt_adds[VALID_RETURN]}"
-
-    new_add_order = []
-    for add in opt_adds:
-        #using select_table since already in (street, postcode) format
-        new_add_order.append(select_table[add["original_index"]])
-
-    d.table_optimisation_update(table, new_add_order, cur)
-    con.commit()
+    if request_data.get('defer'):
+        opt = quick_insert(table, address[0], address[1], cur)
+    else:
+        opt = reoptimise_table(table, cur, request_data.get('budget_ms'))
+    if opt[VALID_STATE] is False:
+        con.rollback()
+        cur.close()
+        return opt[VALID_RETURN]
 
     cur.close()
-    return valid[VALID_RETURN]
+    return valid[VALID_RETURN], 200, {TIER_HEADER: opt[VALID_RETURN]}
 
-@app.route('/delete_value', methods=["POST"])
+@bp.route('/delete_value', methods=["POST"])
 def delete_value():
     """Receive {"table": string, "address": (street, postcode)} 
-    and see if it can be deleted from db, return a success/fail msg"""
+    and see if it can be deleted from db, return a success/fail msg
+    optional "defer": true keeps the stored order and re-optimises in the background
+    optional "budget_ms" bounds the time spent optimising
+    the X-Optimisation-Tier header says how well the stored order was optimised"""
     get_con()
     cur = con.cursor()
 
@@ -123,24 +339,21 @@ def delete_value():
         cur.close()
         return valid[VALID_RETURN]
 
-    select_table = d.select_all(table, cur)
-    addresses = []
-    for result in select_table:
-        addresses.append({"q": f"{result[0]} {result[1]}", "format": "json"})
-
-    opt_adds = optimise_addresses(addresses)
-    new_add_order = []
-    for add in opt_adds:
-        #using select_table since already in (street, postcode) format
-        new_add_order.append(select_table[add["original_index"]])
+    if request_data.get('defer'):
+        #dropping a stop leaves the rest of the stored order valid, so just improve it later
+        schedule(table)
+        cur.close()
+        return valid[VALID_RETURN], 200, {TIER_HEADER: STORED}
 
-    d.table_optimisation_update(table, new_add_order, cur)
-    con.commit()
+    opt = reoptimise_table(table, cur, request_data.get('budget_ms'))
+    if opt[VALID_STATE] is False:
+        cur.close()
+        return opt[VALID_RETURN]
 
     cur.close()
-    return valid[VALID_RETURN]
+    return valid[VALID_RETURN], 200, {TIER_HEADER: opt[VALID_RETURN]}
 
-@app.route('/rollback', methods=["POST"])
+@bp.route('/rollback', methods=["POST"])
 def rollback():
     """Receive {"table": string} if there is a table_rb to revert to - original table dropped
     return status msg"""
@@ -159,7 +372,7 @@ def rollback():
     cur.close()
     return valid[VALID_RETURN]
 
-@app.route('/refresh', methods=["POST"])
+@bp.route('/refresh', methods=["POST"])
 def refresh():
     """Get every table and its contents
     return looks like {table: [(1 House St, A01), ...], ...}"""
@@ -171,5 +384,160 @@ def refresh():
 
     return {"all_data": all_data}
 
+@bp.route('/nearest_round', methods=["POST"])
+def nearest_round():
+    """Receive {"address": (street, postcode)} or {"lat": float, "lon": float}
+    return the rounds with stops closest to it, nearest first
+    return looks like {"rounds": [{"table": string, "distance_km": float}, ...]}"""
+    get_con()
+    cur = con.cursor()
+
+    request_data = request.get_json()
+    if "address" in request_data:
+        address = request_data['address'] #(street, postcode)
+        rnd = r.Round.from_rows(None, [(address[0], address[1])])
+        geos = n.geocode_round(rnd, cur=cur)
+        if geos[VALID_STATE] is False:
+            cur.close()
+            return f"Issue with geocoding address: {geos[VALID_RETURN]}"
+        lat, lon = rnd.coords[0].tolist()
+    else:
+        lat, lon = request_data['lat'], request_data['lon']
+
+    nearest = d.nearest_rounds(lat, lon, cur)
+    cur.close()
+    return {"rounds": [{"table": t, "distance_km": dist} for t, dist in nearest]}
+
+def per_vehicle(value, vehicles, default):
+    """expand an optional per vehicle cap - None, one value for every vehicle, or a list of them"""
+    if value is None:
+        return [default] * vehicles
+    if isinstance(value, list):
+        return value
+    return [value] * vehicles
+
+def whole_number(value):
+    """True for an int, bools are excluded even though python counts them as ints"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def number(value):
+    """True for an int or float, excluding bools"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def split_caps(request_data, vehicles, stops):
+    """Expand and check the per vehicle caps of a /split_round request for a round of stops
+    return (True, (max_stops, max_duration)) with one cap per vehicle, or (False, msg)"""
+    max_stops = per_vehicle(request_data.get('max_stops'), vehicles, stops)
+    max_duration = per_vehicle(request_data.get('max_duration'), vehicles, None)
+    if vehicles < 1 or vehicles * r.MIN_GROUP > stops:
+        return (False, f"Cannot split {stops} stops between {vehicles} vehicles, "
+                       f"each needs at least {r.MIN_GROUP}")
+    if len(max_stops) != vehicles or len(max_duration) != vehicles:
+        return (False, "Per vehicle caps must have one value per vehicle")
+    if not all(whole_number(cap) and cap >= r.MIN_GROUP for cap in max_stops):
+        return (False, f"Stop caps must be whole numbers of at least {r.MIN_GROUP}")
+    if not all(cap is None or (number(cap) and cap > 0) for cap in max_duration):
+        return (False, "Duration caps must be positive numbers of seconds")
+    if sum(max_stops) < stops:
+        return (False, f"Stop caps only allow {sum(max_stops)} of {stops} stops")
+    return (True, (max_stops, max_duration))
+
+@bp.route('/split_round', methods=["POST"])
+def split_round():
+    """Receive {"table": string, "vehicles": int} with optional "max_stops" and "max_duration"
+    (seconds), each a number for every vehicle or a list with one per vehicle
+    split the round into one optimised table per vehicle, named table_1, table_2, ...
+    the original table is kept and the new tables are written together or not at all
+    return a success/fail msg"""
+    get_con()
+    cur = con.cursor()
+
+    request_data = request.get_json()
+    table = request_data['table']
+    vehicles = int(request_data['vehicles'])
+
+    valid = d.table_verification(table)
+    if valid[VALID_STATE] is False:
+        cur.close()
+        return valid[VALID_RETURN]
+    if table not in d.get_all_tables(cur):
+        cur.close()
+        return f"Table {table} does not exist"
+
+    rnd = r.Round.from_stops(table, d.select_stops(table, cur))
+    valid = split_caps(request_data, vehicles, len(rnd))
+    if valid[VALID_STATE] is False:
+        cur.close()
+        return valid[VALID_RETURN]
+    max_stops, max_duration = valid[VALID_RETURN]
+
+    if not rnd.geocoded():
+        geos = n.geocode_round(rnd, cur=cur)
+        if geos[VALID_STATE] is False:
+            cur.close()
+            return f"Issue with geocoding address: {geos[VALID_RETURN]}"
+
+    sub_rounds = [rnd.subset(f"{table}_{i + 1}", group)
+                  for i, group in enumerate(r.partition(rnd.coords, max_stops))]
+    with ThreadPoolExecutor(max_workers=min(vehicles, SPLIT_WORKERS)) as pool:
+        trips = list(pool.map(lambda sub: v.optimise_trip(sub.locations()), sub_rounds))
+
+    for sub, trip, duration in zip(sub_rounds, trips, max_duration):
+        if duration is not None and trip["summary"]["time"] > duration:
+            cur.close()
+            return f"{sub.table} takes {trip['summary']['time']:.0f}s, over its {duration}s cap"
+        sub.apply_trip(trip["locations"])
+
+    valid = d.create_rounds([(sub.table, sub.stops()) for sub in sub_rounds], cur, con, trips)
+    cur.close()
+    return valid[VALID_RETURN]
+
+@bp.route('/route', methods=["POST"])
+def route():
+    """Receive {"table": string} and return the route through the table in its stored order
+    return looks like {"summary": {"time": float, "length": float, ...},
+    "legs": [{"summary": {...}, "shape": encoded polyline}, ...]}
+    served from the route stored at the last optimisation while the table is unchanged"""
+    get_con()
+    cur = con.cursor()
+
+    request_data = request.get_json()
+    table = request_data['table']
+    valid = d.table_verification(table)
+    if valid[VALID_STATE] is False:
+        cur.close()
+        return valid[VALID_RETURN]
+    if table not in d.get_all_tables(cur):
+        cur.close()
+        return f"Table {table} does not exist"
+
+    stored = d.select_route(table, cur)
+    if stored is not None:
+        cur.close()
+        return stored
+
+    rnd = r.Round.from_stops(table, d.select_stops(table, cur))
+    if len(rnd) < 2:
+        cur.close()
+        return f"Table {table} needs at least 2 stops for a route"
+    if not rnd.geocoded():
+        geos = n.geocode_round(rnd, cur=cur)
+        if geos[VALID_STATE] is False:
+            cur.close()
+            return f"Issue with geocoding address: {geos[VALID_RETURN]}"
+
+    stored = d.store_route(table, v.route_trip(rnd.locations()), cur)
+    con.commit()
+    cur.close()
+    return stored
+
+app = create_app()
+
 if __name__=='__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    #development server only, see gunicorn.conf.py for production
+    init_worker(run_scheduler=os.environ.get("WERKZEUG_RUN_MAIN") == "true")
+    try:
+        #requests on one thread like a gunicorn sync worker, sqlite connections can't be shared
+        app.run(debug=True, host='0.0.0.0', port=5000, threaded=False)
+    finally:
+        shutdown()
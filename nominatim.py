@@ -1,22 +1,141 @@
 """Functions related to interacting with the Nominatim engine should be placed here"""
 
+import os
+import time
 import requests
+import database as d
 
-GEO_URL = "http://localhost:7070/search" #Nominatim
+GEO_URL = os.environ.get("GEO_URL", "http://localhost:7070/search") #Nominatim
+LOOKUP_URL = os.environ.get("LOOKUP_URL", f"{GEO_URL.rsplit('/', 1)[0]}/lookup")
+STATUS_URL = f"{GEO_URL.rsplit('/', 1)[0]}/status"
+LOOKUP_BATCH = 50 #most osm_ids nominatim's /lookup accepts in one request
 
-def geocode_adds(addresses):
+#how geocode_round searches for an address it has no OSM id for
+#"free" - free text q=street postcode, nominatim's slowest search path
+#"structured" - street=&postalcode= only
+#"auto" - structured when both parts are given, falling back to free text if it finds nothing
+QUERY_MODE = os.environ.get("GEO_QUERY_MODE", "auto")
+
+session = requests.Session() #keep-alive connections to nominatim, see main.warm_up
+
+def remaining(deadline):
+    """seconds left before a time.monotonic() deadline to use as a request timeout
+    None means no deadline, raises requests.Timeout once it has passed"""
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise requests.Timeout("Geocoding ran out of time")
+    return left
+
+def geocode_adds(addresses, deadline=None):
     """
     Takes a list of dict in the format [ {"q": "<ADDRESS>", "format": "json"} ]
     and returns a list of dict in the format [ {lat: float, lon: float} ]
     if there is an issue with geocoding return the index of the address causing issue
     tuple 0 spot is True/False depending on if geocoding is successful
+    raises requests.Timeout if a time.monotonic() deadline is given and passes
     """
 
     geos = []
+    geocoded = {} #normalised query -> geocode, so a repeated address is only looked up once
     for add in addresses:
-        r = requests.get(GEO_URL, add).json()
-        if not r:
-            return (False, add["q"])
-        print(r)
-        geos.append({"lat": r[0]["lat"], "lon": r[0]["lon"]})
+        key = " ".join(add["q"].split()).upper()
+        if key not in geocoded:
+            r = session.get(GEO_URL, params=add, timeout=remaining(deadline)).json()
+            if not r:
+                return (False, add["q"])
+            geocoded[key] = {"lat": r[0]["lat"], "lon": r[0]["lon"]}
+        geos.append(dict(geocoded[key]))
     return (True, geos)
+
+def osm_id(result):
+    """nominatim result -> its /lookup id eg {"osm_type": "way", "osm_id": 123} -> "W123" """
+    return f"{result['osm_type'][0].upper()}{result['osm_id']}"
+
+def lookup(osm_ids, deadline=None):
+    """
+    Takes a list of osm ids ["W123", "N456", ...] and looks them up in batches of LOOKUP_BATCH
+    returns a dict of the ones found {"W123": (lat, lon), ...}
+    raises requests.Timeout if a time.monotonic() deadline is given and passes
+    """
+
+    found = {}
+    for i in range(0, len(osm_ids), LOOKUP_BATCH):
+        params = {"osm_ids": ",".join(osm_ids[i:i + LOOKUP_BATCH]), "format": "json"}
+        for result in session.get(LOOKUP_URL, params=params, timeout=remaining(deadline)).json():
+            found[osm_id(result)] = (float(result["lat"]), float(result["lon"]))
+    return found
+
+def search(street, postcode, deadline=None, mode=None):
+    """
+    Search for one address using QUERY_MODE (or mode), see QUERY_MODE for the options
+    returns nominatim's first result or None if nothing was found
+    raises requests.Timeout if a time.monotonic() deadline is given and passes
+    """
+
+    mode = mode or QUERY_MODE
+    if mode != "free" and street.strip() and postcode.strip():
+        structured = {"street": street, "postalcode": postcode, "format": "json", "limit": 1}
+        r = session.get(GEO_URL, params=structured, timeout=remaining(deadline)).json()
+        if r or mode == "structured":
+            return r[0] if r else None
+
+    free = {"q": f"{street} {postcode}", "format": "json", "limit": 1}
+    r = session.get(GEO_URL, params=free, timeout=remaining(deadline)).json()
+    return r[0] if r else None
+
+def stored_geocodes(rnd, cur):
+    """fill in rnd.coords for stops whose address was already geocoded for any round
+    returns {position: osm id} of the stops with a known OSM object but no coordinates"""
+    rows = rnd.rows()
+    missing = rnd.missing()
+    known_ids = {}
+    for i, known in zip(missing, d.select_addresses([rows[i] for i in missing], cur)):
+        if known is None:
+            continue
+        if known[0] is not None:
+            rnd.coords[i] = known[:2]
+        elif known[2] is not None:
+            known_ids[i] = known[2]
+    return known_ids
+
+def geocode_round(rnd, deadline=None, cur=None):
+    """
+    Geocodes the stops of a rounds.Round without coordinates, writing lat/lon into rnd.coords
+    with a cur, addresses already geocoded for any round are reused, ones with a known OSM id
+    are fetched together through /lookup, and new geocodes are stored (and committed)
+    so each distinct address is only searched for once
+    tuple 0 spot is True/False depending on if geocoding is successful
+    returns (True, rnd) or (False, "<ADDRESS>") for the first address that can't be geocoded
+    raises requests.Timeout if a time.monotonic() deadline is given and passes
+    """
+
+    rows = rnd.rows()
+    #position -> osm id of stops with a known OSM object but no coordinates
+    known_ids = stored_geocodes(rnd, cur) if cur is not None else {}
+
+    geocoded = {} #normalised address -> (lat, lon, osm id), for addresses repeated in the round
+    found = []
+    try:
+        looked_up = lookup(sorted(set(known_ids.values())), deadline) if known_ids else {}
+        for i in rnd.missing():
+            key = d.address_key(*rows[i])
+            if key not in geocoded:
+                if looked_up.get(known_ids.get(i)) is not None:
+                    geocoded[key] = (*looked_up[known_ids[i]], known_ids[i])
+                else:
+                    result = search(*rows[i], deadline)
+                    if result is None:
+                        return (False, f"{rows[i][0]} {rows[i][1]}")
+                    geocoded[key] = (float(result["lat"]), float(result["lon"]), osm_id(result))
+                found.append((*rows[i], *geocoded[key]))
+            rnd.coords[i] = geocoded[key][:2]
+    finally:
+        if cur is not None and found:
+            #stored even if a later address failed, and committed straight away so the
+            #write lock isn't held over nominatim/valhalla requests
+            for stop in found: #(street, postcode, lat, lon, osm id)
+                d.store_geocode(*stop[:4], cur, osm_id=stop[4])
+            cur.connection.commit()
+    return (True, rnd)
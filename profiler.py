@@ -0,0 +1,126 @@
+"""Opt-in per request profiling of the hot path through main.py, database.py and the engine clients
+a sampled request is run under cProfile and every sqlite statement it executes is timed
+PROFILE_RATE - share of requests profiled, 0 (the default) turns sampling off
+PROFILE_TOKEN - when set, a request with an X-Profile header holding it is always profiled
+PROFILE_DIR - where the .prof files and slowest query logs are written
+with neither set the app connects with a plain sqlite connection
+and the hooks return straight away"""
+
+import cProfile
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+PROFILE_RATE = float(os.environ.get("PROFILE_RATE", 0))
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_HEADER = "X-Profile"
+SLOW_QUERIES = 20 #statements listed in each slowest query log
+
+state = threading.local() #the profile of the request running on this thread, if any
+
+def enabled():
+    """True if any request could be profiled"""
+    return PROFILE_RATE > 0 or bool(PROFILE_TOKEN)
+
+def active():
+    """True while the request on this thread is being profiled"""
+    return getattr(state, "profiler", None) is not None
+
+def should_profile(header=None):
+    """decide whether to profile a request given its X-Profile header value"""
+    if PROFILE_TOKEN and header == PROFILE_TOKEN:
+        return True
+    return PROFILE_RATE > 0 and random.random() < PROFILE_RATE
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording how long each statement takes against the current profile"""
+
+    def execute(self, sql, parameters=(), /):
+        """sqlite3.Cursor.execute, timed"""
+        began = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record(sql, time.perf_counter() - began)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        """sqlite3.Cursor.executemany, timed as one statement"""
+        began = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record(sql, time.perf_counter() - began)
+
+    def executescript(self, sql_script, /):
+        """sqlite3.Cursor.executescript, timed as one statement"""
+        began = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record(sql_script, time.perf_counter() - began)
+
+class ProfiledConnection(sqlite3.Connection): # pylint: disable=too-few-public-methods
+    """Connection handing out TimedCursors while this thread's request is being profiled
+    and plain cursors otherwise, so unsampled requests only pay for the active() check"""
+
+    def cursor(self, factory=None):
+        """sqlite3.Connection.cursor, a TimedCursor while profiling unless factory is given"""
+        if factory is None:
+            factory = TimedCursor if active() else sqlite3.Cursor
+        return super().cursor(factory)
+
+def connection_factory():
+    """connection class for sqlite3.connect(factory=...), plain when profiling is off"""
+    return ProfiledConnection if enabled() else sqlite3.Connection
+
+def record(sql, seconds):
+    """add a statement's time to the current profile, whitespace is collapsed so
+    the same statement from a multi-line string is grouped together"""
+    queries = getattr(state, "queries", None)
+    if queries is None:
+        return
+    sql = re.sub(r"\s+", " ", sql).strip()
+    count, total, worst = queries.get(sql, (0, 0.0, 0.0))
+    queries[sql] = (count + 1, total + seconds, max(worst, seconds))
+
+def start(header=None):
+    """start profiling the request on this thread if it is sampled or asked for by header"""
+    if not enabled() or active() or not should_profile(header):
+        return
+    state.queries = {}
+    state.started = time.perf_counter()
+    state.profiler = cProfile.Profile()
+    state.profiler.enable()
+
+def stop(name):
+    """stop profiling the request on this thread and write its profile and slowest query log
+    return the path of the .prof file written, None if the request wasn't profiled"""
+    if not active():
+        return None
+    profiler, queries = state.profiler, state.queries
+    profiler.disable()
+    elapsed = time.perf_counter() - state.started
+    state.profiler = state.queries = None
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9_]+", "_", name).strip("_") or "request"
+    base = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-"
+                                     f"{threading.get_ident()}-{name}")
+    profiler.dump_stats(f"{base}.prof")
+    write_queries(f"{base}.sql.txt", name, elapsed, queries)
+    return f"{base}.prof"
+
+def write_queries(path, name, elapsed, queries):
+    """write the slowest statements of a request, by total time, one per line"""
+    slowest = sorted(queries.items(), key=lambda query: query[1][1], reverse=True)[:SLOW_QUERIES]
+    total = sum(query[1] for query in queries.values())
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"{name}: {elapsed * 1000:.1f}ms, {len(queries)} distinct statements, "
+                f"{total * 1000:.1f}ms in sqlite\n")
+        f.write("total_ms\tmax_ms\tcount\tstatement\n")
+        for sql, (count, seconds, worst) in slowest:
+            f.write(f"{seconds * 1000:.3f}\t{worst * 1000:.3f}\t{count}\t{sql}\n")
@@ -0,0 +1,254 @@
+"""Array backed representation of a round, passed through geocoding, optimisation and reordering
+so a round isn't rebuilt as lists of dicts/tuples at every step"""
+
+import time
+import numpy as np
+
+LAT = 0 #column of Round.coords holding latitude
+LON = 1 #column of Round.coords holding longitude
+EARTH_RADIUS_KM = 6371.0
+PARTITION_ITERATIONS = 10 #rounds of reassigning stops to the moved centres in partition
+TWO_OPT_LIMIT = 2000 #most stops heuristic_order builds a full distance matrix for
+MIN_GROUP = 2 #fewest stops in a partition group, valhalla needs two locations for a trip
+
+class Round:
+    """A round held as contiguous arrays, one entry per stop in the round's current order
+    streets/postcodes - object arrays of the stored values
+    coords - (n, 2) float array of lat/lon, nan until geocoded
+    trip - valhalla's optimised trip for the round once optimised, else None
+    its legs follow the order apply_trip puts the round in"""
+
+    __slots__ = ("table", "streets", "postcodes", "coords", "trip")
+
+    def __init__(self, table, streets, postcodes):
+        self.table = table
+        self.streets = np.asarray(streets, dtype=object)
+        self.postcodes = np.asarray(postcodes, dtype=object)
+        self.coords = np.full((len(self.streets), 2), np.nan)
+        self.trip = None
+
+    @classmethod
+    def from_rows(cls, table, rows):
+        """build a round from select_all output [("1 House St", "A01"), ...]"""
+        streets = np.empty(len(rows), dtype=object)
+        postcodes = np.empty(len(rows), dtype=object)
+        for i, (street, postcode) in enumerate(rows):
+            streets[i] = street
+            postcodes[i] = postcode
+        return cls(table, streets, postcodes)
+
+    @classmethod
+    def from_stops(cls, table, stops):
+        """build a round with coordinates from select_stops output
+        [("1 House St", "A01", lat, lon), ...] - missing coordinates become nan"""
+        rnd = cls.from_rows(table, [stop[:2] for stop in stops])
+        if not stops:
+            return rnd
+        rnd.coords[:] = [[np.nan if lat is None else lat, np.nan if lon is None else lon]
+                         for _, _, lat, lon in stops]
+        return rnd
+
+    def __len__(self):
+        return len(self.streets)
+
+    def locations(self):
+        """valhalla locations for each stop [ {"lat": float, "lon": float} ]"""
+        return [{"lat": lat, "lon": lon} for lat, lon in self.coords.tolist()]
+
+    def apply_trip(self, locations):
+        """reorder the round in place to match valhalla's trip locations
+        [ {"lat": float, "lon": float, "original_index": int}, ...]
+        original_index refers to the order the stops were sent in ie the current order"""
+        order = np.fromiter((loc["original_index"] for loc in locations),
+                            dtype=np.intp, count=len(locations))
+        self.reorder(order)
+        #valhalla echoes every location so its coordinates are already in the new order
+        self.coords[:, LAT] = np.fromiter((loc["lat"] for loc in locations),
+                                          dtype=float, count=len(locations))
+        self.coords[:, LON] = np.fromiter((loc["lon"] for loc in locations),
+                                          dtype=float, count=len(locations))
+
+    def reorder(self, order):
+        """permute every array of the round by order, an array of current positions"""
+        self.streets = self.streets[order]
+        self.postcodes = self.postcodes[order]
+        self.coords = self.coords[order]
+
+    def geocoded(self):
+        """True when every stop of the round has coordinates"""
+        return not np.isnan(self.coords).any()
+
+    def missing(self):
+        """positions of the stops without coordinates"""
+        return np.flatnonzero(np.isnan(self.coords).any(axis=1)).tolist()
+
+    def insertion_index(self, lat, lon):
+        """position to insert a stop at that adds the least straight line distance to the round
+        the first and last stops stay in place, valhalla treats them as the start and end"""
+        if len(self) < 2:
+            return len(self)
+
+        to_new = haversine(self.coords, lat, lon)
+        legs = haversine(self.coords[:-1], self.coords[1:, LAT], self.coords[1:, LON])
+        detour = to_new[:-1] + to_new[1:] - legs
+        return int(np.argmin(detour)) + 1
+
+    def insert(self, index, street, postcode, lat, lon):
+        """insert a stop into the round at index"""
+        self.streets = np.insert(self.streets, index, street)
+        self.postcodes = np.insert(self.postcodes, index, postcode)
+        self.coords = np.insert(self.coords, index, (lat, lon), axis=0)
+
+    def subset(self, table, index):
+        """new round named table holding the stops at positions index, in that order"""
+        rnd = Round(table, self.streets[index], self.postcodes[index])
+        rnd.coords = self.coords[index]
+        return rnd
+
+    def rows(self):
+        """(street, postcode) per stop in round order, the format the tables store"""
+        return list(zip(self.streets.tolist(), self.postcodes.tolist()))
+
+    def stops(self):
+        """(street, postcode, lat, lon) per stop in round order, the format index_stops takes"""
+        return [(street, postcode, lat, lon) for street, postcode, (lat, lon)
+                in zip(self.streets.tolist(), self.postcodes.tolist(), self.coords.tolist())]
+
+def haversine(coords, lat, lon):
+    """great circle distance in km from each (lat, lon) row of coords to lat/lon
+    lat/lon may be scalars or arrays the same length as coords"""
+    phi1 = np.radians(coords[:, LAT])
+    phi2 = np.radians(lat)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(lon) - np.radians(coords[:, LON])
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def spread_seeds(coords, k):
+    """positions of k stops spread across coords, starting furthest from the centre
+    and then repeatedly taking the stop furthest from those already chosen"""
+    centre = coords.mean(axis=0)
+    seeds = [int(np.argmax(haversine(coords, centre[LAT], centre[LON])))]
+    nearest = haversine(coords, coords[seeds[0], LAT], coords[seeds[0], LON])
+    for _ in range(1, k):
+        seeds.append(int(np.argmax(nearest)))
+        nearest = np.minimum(nearest, haversine(coords, coords[seeds[-1], LAT],
+                                                coords[seeds[-1], LON]))
+    return seeds
+
+def partition(coords, caps, min_size=MIN_GROUP):
+    """split stops into len(caps) geographically compact groups, group i holding at most caps[i]
+    capacitated k-means from spread out seeds (see spread_seeds) - each group is given
+    its min_size nearest stops, then the rest are assigned,
+    most constrained first, to the nearest centre with room left
+    caller ensures len(coords) >= len(caps) * min_size and every cap >= min_size
+    returns a list of position arrays, one per group"""
+    n, k = len(coords), len(caps)
+    caps = np.asarray(caps)
+    centres = coords[spread_seeds(coords, k)]
+
+    assignment = np.full(n, -1)
+    for _ in range(PARTITION_ITERATIONS):
+        dist = np.stack([haversine(coords, lat, lon) for lat, lon in centres], axis=1)
+        ranked = np.sort(dist, axis=1)
+        #stops that lose the most by missing their nearest centre choose first
+        regret = ranked[:, 1] - ranked[:, 0] if k > 1 else ranked[:, 0]
+        new_assignment = np.full(n, -1)
+        room = caps.copy()
+        #reserving stops first means no group is left empty or with a lone stop
+        for group in range(k):
+            free = np.where(new_assignment == -1, dist[:, group], np.inf)
+            for stop in np.argsort(free, kind="stable")[:min_size]:
+                new_assignment[stop] = group
+                room[group] -= 1
+        for stop in np.argsort(-regret, kind="stable"):
+            if new_assignment[stop] != -1:
+                continue
+            for group in np.argsort(dist[stop], kind="stable"):
+                if room[group] > 0:
+                    new_assignment[stop] = group
+                    room[group] -= 1
+                    break
+
+        if np.array_equal(new_assignment, assignment):
+            break
+        assignment = new_assignment
+        centres = np.array([coords[assignment == group].mean(axis=0)
+                            if (assignment == group).any() else centres[group]
+                            for group in range(k)])
+
+    return [np.flatnonzero(assignment == group) for group in range(k)]
+
+def distance_matrix(coords):
+    """(n, n) great circle distances in km between every pair of coords"""
+    if len(coords) == 0:
+        return np.empty((0, 0))
+    return np.stack([haversine(coords, lat, lon) for lat, lon in coords], axis=1)
+
+def nearest_neighbour(coords, deadline=float("inf")):
+    """order that keeps going to the nearest unvisited stop, starting at the first stop
+    and finishing at the last so the start and end stay fixed like valhalla's
+    if the time.monotonic() deadline passes the unvisited stops follow in their current order"""
+    n = len(coords)
+    if n < 3:
+        return np.arange(n)
+
+    order = [0]
+    unvisited = np.ones(n, dtype=bool)
+    unvisited[[0, n - 1]] = False
+    for _ in range(n - 2):
+        if time.monotonic() >= deadline:
+            order.extend(np.flatnonzero(unvisited).tolist())
+            break
+        dist = haversine(coords, coords[order[-1], LAT], coords[order[-1], LON])
+        dist[~unvisited] = np.inf
+        order.append(int(np.argmin(dist)))
+        unvisited[order[-1]] = False
+    order.append(n - 1)
+    return np.array(order)
+
+def heuristic_order(coords, deadline):
+    """quick straight line order for when there's no time to wait for valhalla
+    nearest neighbour, then 2-opt until the time.monotonic() deadline for rounds small enough
+    and only if there's time left to build the distance matrix 2-opt needs"""
+    start = time.monotonic()
+    order = nearest_neighbour(coords, deadline)
+    #nearest neighbour computes the same n x n distances as the matrix, so it took about as long
+    elapsed = time.monotonic() - start
+    if len(order) > TWO_OPT_LIMIT or time.monotonic() + elapsed >= deadline:
+        return order
+    return order[two_opt(distance_matrix(coords[order]), deadline)]
+
+def path_cost(cost, order):
+    """total cost of visiting stops in order given a cost matrix, start and end aren't joined"""
+    return float(cost[order[:-1], order[1:]].sum())
+
+def two_opt(cost, deadline):
+    """improve the current order (0, 1, ..., n-1) with 2-opt moves until none help or the
+    time.monotonic() deadline passes - the first and last stops never move
+    returns the best order found, which is never worse than the current one"""
+    n = len(cost)
+    start = np.arange(n)
+    tour = start.copy()
+    sym = (cost + cost.T) / 2 #2-opt reverses segments, so judge moves on a symmetric cost
+
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(n - 3):
+            #reverse tour[i+1..j] for every j at once
+            #swapping edges (a, b) & (c, e) for (a, c) & (b, e)
+            a, b = tour[i], tour[i + 1]
+            c, e = tour[i + 2:n - 1], tour[i + 3:n]
+            delta = sym[a, c] + sym[b, e] - sym[a, b] - sym[c, e]
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                j = best + i + 2
+                tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1].copy()
+                improved = True
+            if time.monotonic() >= deadline:
+                break
+
+    if path_cost(cost, tour) < path_cost(cost, start):
+        return tour
+    return start
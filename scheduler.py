@@ -0,0 +1,175 @@
+"""Background re-optimisation of stored rounds while the service is idle
+edits can store a quick heuristic order and leave improving it to the scheduler
+only one worker runs the scheduler, so every worker queues rounds in meta.queue
+and marks its requests on an activity file next to the database"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import database as d
+import nominatim as n
+import rounds as r
+import valhalla as v
+
+EDITED = 0 #priority of a round queued by an edit, lower runs first
+IDLE = 1 #priority of a round queued by the periodic sweep of every round
+
+IDLE_AFTER = 2.0 #seconds without a request before background work starts
+EDIT_BUDGET = 2.0 #seconds of 2-opt per edited round
+SWEEP_BUDGET = 10.0 #seconds of 2-opt per round in a sweep
+SWEEP_INTERVAL = 600.0 #seconds between sweeps of every round
+POLL_INTERVAL = 1.0 #seconds between checks of the shared queue when nothing is waiting
+VALHALLA_RATE = 1.0 #cost matrix requests per second
+VALHALLA_BURST = 2 #cost matrix requests allowed back to back
+
+logger = logging.getLogger(__name__)
+
+def activity_path(db_path):
+    """file whose modified time is the last request seen by any worker"""
+    return f"{db_path}.activity"
+
+def touch(db_path):
+    """record request activity for db_path, background work waits for idle_after seconds of quiet"""
+    path = activity_path(db_path)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        with open(path, "a", encoding="utf-8"):
+            pass
+
+def last_activity(db_path):
+    """time.time() of the last request any worker recorded, 0 if there hasn't been one"""
+    try:
+        return os.path.getmtime(activity_path(db_path))
+    except FileNotFoundError:
+        return 0.0
+
+class RateLimiter: # pylint: disable=too-few-public-methods
+    """Token bucket limiting how often the scheduler calls valhalla"""
+
+    def __init__(self, rate=VALHALLA_RATE, burst=VALHALLA_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def acquire(self, stop_event):
+        """block until a token is available, return False if stop_event was set while waiting"""
+        while not stop_event.is_set():
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            stop_event.wait((1 - self.tokens) / self.rate)
+        return False
+
+class Scheduler:
+    """Re-optimises queued rounds on a background thread using their stored order as a warm start
+    rounds queued by edits run before sweep rounds, and nothing runs until requests go quiet"""
+
+    def __init__(self, db_path, idle_after=IDLE_AFTER, sweep_interval=SWEEP_INTERVAL,
+                 limiter=None):
+        self.db_path = db_path
+        self.idle_after = idle_after
+        self.sweep_interval = sweep_interval
+        self.limiter = limiter or RateLimiter()
+
+        self.stop_event = threading.Event()
+        self.last_sweep = time.monotonic()
+        self.thread = None
+
+    def start(self):
+        """start the background thread"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="reoptimise", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """ask the background thread to finish its current round and exit"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def next_table(self, con):
+        """block until the service is idle and a round is queued
+        return (table, priority) or None when stopping"""
+        cur = con.cursor()
+        while not self.stop_event.is_set():
+            if time.monotonic() - self.last_sweep >= self.sweep_interval:
+                self.sweep(cur)
+
+            quiet = time.time() - last_activity(self.db_path)
+            if quiet >= self.idle_after:
+                item = d.pop_round(cur)
+                con.commit()
+                if item is not None:
+                    return item
+                wait = POLL_INTERVAL
+            else:
+                wait = self.idle_after - quiet
+            self.stop_event.wait(max(wait, 0.05))
+        return None
+
+    def sweep(self, cur):
+        """queue every round at IDLE priority"""
+        self.last_sweep = time.monotonic()
+        d.enqueue_rounds(IDLE, cur)
+        cur.connection.commit()
+
+    def run(self):
+        """background thread loop, uses its own connection since sqlite ones can't be shared"""
+        con = sqlite3.connect(self.db_path)
+        d.attach_meta(con.cursor())
+        while True:
+            item = self.next_table(con)
+            if item is None:
+                break
+            table, priority = item
+            budget = EDIT_BUDGET if priority == EDITED else SWEEP_BUDGET
+            try:
+                reoptimise(table, budget, con, self.limiter, self.stop_event)
+            except Exception: # pylint: disable=broad-exception-caught
+                #one bad round or a valhalla outage mustn't kill the thread
+                con.rollback()
+                logger.exception("Background re-optimisation of %s failed", table)
+        con.close()
+
+def reoptimise(table, budget, con, limiter, stop_event):
+    """Improve a round's stored order with 2-opt over a valhalla cost matrix within budget seconds
+    the stored order is the starting point so the result is never worse than it
+    return a (True/False, msg) tuple"""
+    cur = con.cursor()
+    stops = d.select_stops(table, cur)
+    rnd = r.Round.from_stops(table, stops)
+    if len(rnd) < 4:
+        return (False, f"Table {table} is too small to improve")
+    if not rnd.geocoded():
+        #stops an edit ran out of time to geocode
+        geos = n.geocode_round(rnd, cur=cur)
+        if geos[0] is False:
+            return (False, f"Issue with geocoding address: {geos[1]}")
+        d.index_stops(table, rnd.stops(), cur)
+        con.commit()
+
+    if not limiter.acquire(stop_event):
+        return (False, "Scheduler stopping")
+    cost = v.cost_matrix(rnd.locations())
+    order = r.two_opt(cost, time.monotonic() + budget)
+    if np.array_equal(order, np.arange(len(rnd))):
+        return (False, f"Table {table} already optimal")
+
+    expected = rnd.rows()
+    rnd.reorder(order)
+    valid = d.table_reorder(table, expected, rnd.rows(), cur)
+    if valid[0] is False:
+        con.rollback()
+        return valid
+    con.commit()
+    return valid
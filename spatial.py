@@ -0,0 +1,71 @@
+"""Geohash and distance helpers used by the stop index in database.py"""
+
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+INDEX_PRECISION = 9 #~5m cells, precision stored against every indexed stop
+SEARCH_PRECISION = 7 #~150m cells, finest precision nearest_rounds starts searching at
+EARTH_RADIUS_KM = 6371.0
+
+def encode(lat, lon, precision=INDEX_PRECISION):
+    """encode a lat/lon into a geohash string of the given length"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True #geohash interleaves bits starting with longitude
+
+    while len(geohash) < precision:
+        rng, val = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if val >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+def cell_size(precision):
+    """return the (lat, lon) size in degrees of a geohash cell of the given length"""
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+    return (180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits)
+
+def cover_radius(lat, precision):
+    """radius in km around lat that neighbours(lat, lon, precision) is sure to cover
+    the 3x3 block reaches at least one whole cell past the centre cell on every side,
+    cells are narrowest in km at the block's edge furthest from the equator"""
+    lat_step, lon_step = cell_size(precision)
+    widest_lat = min(abs(lat) + 2 * lat_step, 90.0)
+    km_per_degree = math.pi * EARTH_RADIUS_KM / 180
+    return min(lat_step, lon_step * math.cos(math.radians(widest_lat))) * km_per_degree
+
+def neighbours(lat, lon, precision):
+    """return the geohash cell containing lat/lon plus its 8 surrounding cells
+    used so a search near a cell edge still finds stops just over the boundary"""
+    lat_step, lon_step = cell_size(precision)
+    cells = set()
+    for d_lat in (-lat_step, 0, lat_step):
+        for d_lon in (-lon_step, 0, lon_step):
+            n_lat = min(max(lat + d_lat, -90.0), 90.0)
+            n_lon = (lon + d_lon + 180.0) % 360.0 - 180.0
+            cells.add(encode(n_lat, n_lon, precision))
+    return sorted(cells)
+
+def haversine(lat1, lon1, lat2, lon2):
+    """great circle distance in km between two points"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
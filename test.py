@@ -1,9 +1,26 @@
 """Unit tests for whole project are placed here"""
+#every test lives in this one file, grouped into a test case per module
+# pylint: disable=too-many-lines,too-many-public-methods
 
+import math
+import os
+import pstats
+import tempfile
 import unittest
 import sqlite3
-from unittest.mock import patch
+import threading
+import time
+from unittest.mock import MagicMock, patch
+import numpy as np
+import requests
 import database as d
+import nominatim as n
+import profiler as p
+import rounds as r
+import scheduler as s
+import spatial
+import valhalla as v
+import main
 from main import app
 
 class MainTestCase(unittest.TestCase):
@@ -205,6 +222,247 @@ class MainTestCase(unittest.TestCase):
         cur.execute("DROP TABLE no_rollback;")
         cur.close()
 
+    @patch("main.DB_PATH", "test.db")
+    def test_nearest_round(self):
+        """test /nearest_round returns the rounds nearest to a lat/lon"""
+        cur = self.con.cursor()
+        d.index_stops("dummy", [("2 House St", "A01", 51.5, -0.1),
+                                ("3 House St", "A01", 51.5005, -0.1)], cur)
+        self.con.commit()
+        cur.close()
+
+        response = self.app.post("/nearest_round", json={"lat": 51.5001, "lon": -0.1})
+        self.assertEqual(response.json["rounds"][0]["table"], "dummy")
+        self.assertLess(response.json["rounds"][0]["distance_km"], 0.1)
+
+    @patch("main.v.optimise_trip")
+    @patch("main.DB_PATH", "test.db")
+    def test_split_round(self, mock_trip):
+        """test /split_round writes one table per vehicle and honours the caps"""
+        mock_trip.side_effect = lambda locs: {
+            "locations": [{**loc, "original_index": i} for i, loc in enumerate(locs)],
+            "summary": {"time": 100 * len(locs)},
+            "legs": [{"summary": {"time": 100}, "shape": "shape"}] * (len(locs) - 1)}
+        cur = self.con.cursor()
+        d.insert_value("dummy", "1 Far Rd", "B01", cur, self.con)
+        d.insert_value("dummy", "2 Far Rd", "B01", cur, self.con)
+        d.index_stops("dummy", [("2 House St", "A01", 51.50, -0.1),
+                                ("3 House St", "A01", 51.501, -0.1),
+                                ("1 Far Rd", "B01", 52.0, -1.0),
+                                ("2 Far Rd", "B01", 52.001, -1.0)], cur)
+        self.con.commit()
+
+        over = self.app.post("/split_round", json={"table": "dummy", "vehicles": 2,
+                                                   "max_duration": 150})
+        self.assertEqual(over.text, "dummy_1 takes 200s, over its 150s cap")
+        self.assertNotIn("dummy_1", d.get_all_tables(cur))
+
+        for cap in (1, -3, "2", 2.5):
+            capped = self.app.post("/split_round", json={"table": "dummy", "vehicles": 2,
+                                                         "max_stops": cap})
+            self.assertEqual(capped.text, "Stop caps must be whole numbers of at least 2")
+        lone = self.app.post("/split_round", json={"table": "dummy", "vehicles": 3})
+        self.assertEqual(lone.text,
+                         "Cannot split 4 stops between 3 vehicles, each needs at least 2")
+
+        response = self.app.post("/split_round", json={"table": "dummy", "vehicles": 2})
+        self.assertEqual(response.text, "Tables dummy_1, dummy_2 created")
+        all_data = d.get_all_tables(cur)
+        self.assertCountEqual([all_data["dummy_1"], all_data["dummy_2"]],
+                              [[("2 House St", "A01"), ("3 House St", "A01")],
+                               [("1 Far Rd", "B01"), ("2 Far Rd", "B01")]])
+        self.assertEqual(len(all_data["dummy"]), 4)
+        self.assertEqual(d.select_route("dummy_1", cur)["summary"], {"time": 200})
+        cur.close()
+
+    @patch("main.v.route_trip")
+    @patch("main.DB_PATH", "test.db")
+    def test_route(self, mock_route):
+        """test /route serves the stored route until the table changes"""
+        trip = {"summary": {"time": 60, "length": 1.0},
+                "legs": [{"summary": {"time": 60, "length": 1.0}, "shape": "abc",
+                          "maneuvers": []}]}
+        mock_route.return_value = trip
+        cur = self.con.cursor()
+        d.index_stops("dummy", [("2 House St", "A01", 51.50, -0.1),
+                                ("3 House St", "A01", 51.51, -0.1)], cur)
+        d.store_route("dummy", trip, cur)
+        self.con.commit()
+
+        stored = self.app.post("/route", json={"table": "dummy"})
+        self.assertDictEqual(stored.json, {"summary": {"time": 60, "length": 1.0},
+                                           "legs": [{"summary": {"time": 60, "length": 1.0},
+                                                     "shape": "abc"}]})
+        mock_route.assert_not_called()
+
+        d.rollback_table("dummy", cur, self.con) #leaves 2 House St only
+        self.assertIsNone(d.select_route("dummy", cur))
+        few = self.app.post("/route", json={"table": "dummy"})
+        self.assertEqual(few.text, "Table dummy needs at least 2 stops for a route")
+
+        d.insert_value("dummy", "3 House St", "A01", cur, self.con)
+        d.index_stops("dummy", [("2 House St", "A01", 51.50, -0.1),
+                                ("3 House St", "A01", 51.51, -0.1)], cur)
+        self.con.commit()
+        self.app.post("/route", json={"table": "dummy"})
+        mock_route.assert_called_once_with([{"lat": 51.50, "lon": -0.1},
+                                            {"lat": 51.51, "lon": -0.1}])
+        self.assertIsNotNone(d.select_route("dummy", cur))
+        cur.close()
+
+    @patch("main.v.optimise_trip")
+    @patch("main.n.geocode_adds")
+    def test_optimise_budget(self, mock_geo, mock_trip):
+        """test /optimise with a budget falls back to the heuristic order when valhalla is late"""
+        mock_geo.return_value = (True, [{"lat": "51.50", "lon": "-0.1"},
+                                        {"lat": "51.52", "lon": "-0.1"},
+                                        {"lat": "51.51", "lon": "-0.1"},
+                                        {"lat": "51.53", "lon": "-0.1"}])
+        mock_trip.side_effect = requests.Timeout()
+
+        response = self.app.post("/optimise", json={"addresses": [{}] * 4, "budget_ms": 500})
+        self.assertEqual(response.headers["X-Optimisation-Tier"], "heuristic")
+        self.assertListEqual([add["original_index"] for add in response.json], [0, 2, 1, 3])
+
+        mock_geo.side_effect = requests.Timeout()
+        response = self.app.post("/optimise", json={"addresses": [{}] * 4, "budget_ms": 500})
+        self.assertEqual(response.headers["X-Optimisation-Tier"], "stored")
+        self.assertListEqual([add["original_index"] for add in response.json], [0, 1, 2, 3])
+
+    @patch("main.v.optimise_trip")
+    @patch("main.DB_PATH", "test.db")
+    def test_insert_value_budget(self, mock_trip):
+        """test an insert with a budget stores valhalla's order when it answers in time"""
+        mock_trip.side_effect = lambda locs, timeout: {
+            "locations": [{**loc, "original_index": i}
+                          for i, loc in reversed(list(enumerate(locs)))],
+            "summary": {"time": 100}, "legs": [{"summary": {"time": 50}, "shape": "abc"}] * 2}
+        cur = self.con.cursor()
+        d.index_stops("dummy", [("2 House St", "A01", 51.50, -0.1),
+                                ("3 House St", "A01", 51.52, -0.1),
+                                ("1 House St", "A01", 51.51, -0.1)], cur)
+        self.con.commit()
+
+        response = self.app.post("/insert_value", json={"table": "dummy", "budget_ms": 1000,
+                                                        "address": ("1 House St", "A01")})
+        self.assertEqual(response.text, "Inserted values (1 House St, A01) into dummy")
+        self.assertEqual(response.headers["X-Optimisation-Tier"], "optimised")
+        #valhalla reverses the order it was sent, which is the stored one
+        self.assertListEqual(d.select_all("dummy", cur), [("1 House St", "A01"),
+                                                          ("3 House St", "A01"),
+                                                          ("2 House St", "A01")])
+        self.assertEqual(d.select_route("dummy", cur)["summary"], {"time": 100})
+        cur.close()
+
+    @patch("main.v.optimise_trip")
+    @patch("main.DB_PATH", "test.db")
+    def test_delete_value_budget_last(self, mock_trip):
+        """test deleting down to one stop and then none with a budget doesn't ask valhalla"""
+        cur = self.con.cursor()
+        d.index_stops("dummy", [("2 House St", "A01", 51.50, -0.1),
+                                ("3 House St", "A01", 51.52, -0.1)], cur)
+        self.con.commit()
+
+        for street in ("3 House St", "2 House St"):
+            response = self.app.post("/delete_value", json={"table": "dummy", "budget_ms": 1000,
+                                                            "address": (street, "A01")})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["X-Optimisation-Tier"], "optimised")
+        mock_trip.assert_not_called()
+        self.assertListEqual(d.select_all("dummy", cur), [])
+        cur.close()
+
+    @patch("main.DB_PATH", "test.db")
+    def test_create_app(self):
+        """test the app factory serves the same routes and shutdown closes the connection"""
+        client = main.create_app().test_client()
+        response = client.post("/create_table", json={"table": "tester"})
+        self.assertEqual(response.text, "Table tester created")
+
+        main.shutdown()
+        self.assertIsNone(main.con)
+
+    def test_warm_up(self):
+        """test a worker drops inherited connections and carries on if an engine is down"""
+        session = MagicMock()
+        self.assertTrue(main.warm_up(session, "http://engine/status"))
+        session.close.assert_called_once_with()
+        session.get.assert_called_once_with("http://engine/status", timeout=main.WARM_UP_TIMEOUT)
+
+        session.get.side_effect = requests.ConnectionError
+        self.assertFalse(main.warm_up(session, "http://engine/status"))
+
+    def test_wsgi_app(self):
+        """test the WSGI entry point serves the same app as main rather than a second one"""
+        import wsgi # pylint: disable=import-outside-toplevel
+        self.assertIs(wsgi.app, main.app)
+
+    @patch("main.DB_PATH", "test.db")
+    def test_insert_value_osm_id_rejected(self):
+        """test a rejected insert leaves the shared geocode of its address alone"""
+        cur = self.con.cursor()
+        d.index_stops("dummy", [("2 House St", "A01", 51.50, -0.1),
+                                ("3 House St", "A01", 51.52, -0.1)], cur)
+        self.con.commit()
+
+        response = self.app.post("/insert_value", json={"table": "dummy", "osm_id": "W5",
+                                                        "address": ("2 House St", "A01")})
+        self.assertEqual(response.text, "Street and postcode already in database")
+        response = self.app.post("/insert_value", json={"table": "dummy", "osm_id": "5",
+                                                        "address": ("9 House St", "A01")})
+        self.assertEqual(response.text,
+                         "Invalid OSM id. Please use N, W or R followed by the numeric id")
+        main.con.commit() #an unrelated commit mustn't save anything from the rejected inserts
+
+        self.assertListEqual(d.select_stops("dummy", cur), [("2 House St", "A01", 51.50, -0.1),
+                                                            ("3 House St", "A01", 51.52, -0.1)])
+        self.assertListEqual(d.select_addresses([("9 House St", "A01")], cur), [None])
+        self.assertListEqual(cur.execute("SELECT street FROM dummy").fetchall(),
+                             [("2 House St",), ("3 House St",)])
+        cur.close()
+
+    @patch("main.DB_PATH", "test.db")
+    def test_insert_value_defer(self):
+        """test a deferred insert places the stop between its neighbours without optimising"""
+        cur = self.con.cursor()
+        d.insert_value("dummy", "4 House St", "A01", cur, self.con)
+        d.index_stops("dummy", [("2 House St", "A01", 51.50, -0.1),
+                                ("3 House St", "A01", 51.52, -0.1),
+                                ("4 House St", "A01", 51.53, -0.1)], cur)
+        #geocoded for another round already, so nominatim isn't asked again
+        d.store_geocode("1  house st", "a01", "51.51", "-0.1", cur)
+        self.con.commit()
+
+        response = self.app.post("/insert_value", json={"table": "dummy", "defer": True,
+                                                        "address": ("1 House St", "A01")})
+        self.assertEqual(response.text, "Inserted values (1 House St, A01) into dummy")
+
+        result_dummy = cur.execute("SELECT street, postcode FROM dummy").fetchall()
+        self.assertListEqual(result_dummy, [("2 House St", "A01"), ("1 House St", "A01"),
+                                            ("3 House St", "A01"), ("4 House St", "A01")])
+        cur.close()
+
+    @patch("main.serving", True)
+    @patch("main.DB_PATH", "test.db")
+    @patch("nominatim.session", autospec=True)
+    def test_insert_value_defer_unindexed(self, session):
+        """test a deferred insert into a round without coordinates is left to the scheduler"""
+        cur = self.con.cursor()
+        d.index_stops("dummy", [], cur) #earlier tests may have indexed dummy
+        cur.execute("DELETE FROM meta.queue;")
+        self.con.commit()
+
+        response = self.app.post("/insert_value", json={"table": "dummy", "defer": True,
+                                                        "address": ("4 House St", "A01")})
+        self.assertEqual(response.text, "Inserted values (4 House St, A01) into dummy")
+        self.assertEqual(response.headers[main.TIER_HEADER], main.STORED)
+        session.get.assert_not_called()
+
+        result_dummy = cur.execute("SELECT street FROM dummy").fetchall()
+        self.assertListEqual(result_dummy, [("2 House St",), ("3 House St",), ("4 House St",)])
+        self.assertListEqual(cur.execute("SELECT round FROM meta.queue").fetchall(), [("dummy",)])
+        cur.close()
+
     def tearDown(self):
         """double check test tables wiped"""
         cur = self.con.cursor()
@@ -212,9 +470,21 @@ class MainTestCase(unittest.TestCase):
         cur.execute("DROP TABLE IF EXISTS dummy_rb;")
         cur.execute("DROP TABLE IF EXISTS tester;")
         cur.execute("DROP TABLE IF EXISTS tester_rb;")
+        #split tables have indexed stops and routes, which a plain drop would leave behind
+        d.delete_table("dummy_1", cur, self.con)
+        d.delete_table("dummy_2", cur, self.con)
         cur.close()
         return super().tearDown()
 
+    @patch("main.DB_PATH", "test.db")
+    def test_route_empty(self):
+        """test /route on an empty table says it needs stops rather than failing"""
+        cur = self.con.cursor()
+        d.create_table("dummy_1", cur, self.con)
+        cur.close()
+        response = self.app.post("/route", json={"table": "dummy_1"})
+        self.assertEqual(response.text, "Table dummy_1 needs at least 2 stops for a route")
+
 class DatabaseTestCase(unittest.TestCase):
     """Class for testing the functions of database.py"""
 
@@ -228,6 +498,9 @@ class DatabaseTestCase(unittest.TestCase):
         """ensure dummy table is wiped"""
         cur = self.con.cursor()
         cur.executescript("DROP TABLE IF EXISTS dummy; DROP TABLE IF EXISTS dummy_rb")
+        d.attach_meta(cur)
+        cur.execute("DELETE FROM meta.stops;")
+        self.con.commit()
         cur.close()
         return super().setUp()
 
@@ -487,6 +760,252 @@ class DatabaseTestCase(unittest.TestCase):
 
         self.assertDictEqual(output, expected)
 
+    def test_select_all_cache(self):
+        """test select_all is served from the cache until the table changes through database.py"""
+        cur = self.con.cursor()
+        d.create_table("dummy", cur, self.con)
+        d.insert_value("dummy", "1 House St", "A01", cur, self.con)
+        self.assertListEqual(d.select_all("dummy", cur), [("1 House St", "A01")])
+
+        #a change made behind database.py's back isn't seen, the cached rows are served
+        cur.execute("DELETE FROM dummy;")
+        self.con.commit()
+        self.assertListEqual(d.select_all("dummy", cur), [("1 House St", "A01")])
+
+        d.insert_value("dummy", "2 House St", "A01", cur, self.con)
+        self.assertListEqual(d.select_all("dummy", cur), [("2 House St", "A01")])
+
+        cur.close()
+
+    def test_cache_other_connection(self):
+        """test a change committed by another connection invalidates this connection's cache"""
+        cur = self.con.cursor()
+        d.create_table("dummy", cur, self.con)
+        d.insert_value("dummy", "1 House St", "A01", cur, self.con)
+        self.assertDictEqual(d.get_all_tables(cur), {"dummy": [("1 House St", "A01")]})
+
+        other = sqlite3.connect("test.db")
+        other_cur = other.cursor()
+        d.insert_value("dummy", "2 House St", "A01", other_cur, other)
+        d.create_table("dummy1", other_cur, other)
+        other_cur.close()
+        other.close()
+
+        self.assertDictEqual(d.get_all_tables(cur), {"dummy": [("1 House St", "A01"),
+                                                               ("2 House St", "A01")],
+                                                     "dummy1": []})
+        cur.close()
+
+    def test_cache_threads(self):
+        """test the cache stays consistent while another thread keeps changing rounds"""
+        cur = self.con.cursor()
+        d.create_table("dummy", cur, self.con)
+        d.insert_value("dummy", "1 House St", "A01", cur, self.con)
+        errors = []
+
+        def reorder():
+            other = sqlite3.connect("test.db", timeout=10)
+            other_cur = other.cursor()
+            try:
+                for _ in range(200):
+                    d.attach_meta(other_cur)
+                    d.bump_version("dummy", other_cur)
+                    other.commit()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                errors.append(e)
+            other.close()
+
+        thread = threading.Thread(target=reorder)
+        thread.start()
+        while thread.is_alive():
+            self.assertListEqual(d.select_all("dummy", cur), [("1 House St", "A01")])
+            self.assertIn("dummy", d.get_all_tables(cur))
+        thread.join()
+        self.assertListEqual(errors, [])
+        cur.close()
+
+    def test_address_key(self):
+        """test addresses are normalised for case, whitespace and postcode format"""
+        self.assertEqual(d.address_key(" 1  house st ", "sw1a1aa"), ("1 HOUSE ST", "SW1A 1AA"))
+        self.assertEqual(d.address_key("1 House St", " SW1A  1AA"), ("1 HOUSE ST", "SW1A 1AA"))
+        self.assertEqual(d.address_key("1 House St", "a01"), ("1 HOUSE ST", "A01"))
+
+    @patch("nominatim.session", autospec=True)
+    def test_geocode_adds(self, mock_session):
+        """test repeated addresses are geocoded once, with the query sent as params"""
+        mock_session.get.return_value.json.return_value = [{"lat": "51.5", "lon": "-0.1"}]
+        geos = n.geocode_adds([{"q": "1 House St A01", "format": "json"},
+                               {"q": "1 house st  a01", "format": "json"}])
+        self.assertEqual(geos, (True, [{"lat": "51.5", "lon": "-0.1"}] * 2))
+        self.assertEqual(mock_session.get.call_count, 1)
+        self.assertEqual(mock_session.get.call_args.kwargs["params"]["q"], "1 House St A01")
+
+    @patch("nominatim.session", autospec=True)
+    def test_geocode_round_shared(self, mock_session):
+        """test each distinct address is geocoded once across rounds"""
+        cur = self.con.cursor()
+        cur.execute("DELETE FROM meta.addresses;")
+        self.con.commit()
+        mock_session.get.return_value.json.return_value = [{"lat": "51.5", "lon": "-0.1",
+                                                             "osm_type": "way", "osm_id": 1}]
+
+        first = r.Round.from_rows("dummy1", [("1 House St", "A01"), ("1 HOUSE ST ", "a01")])
+        self.assertTrue(n.geocode_round(first, cur=cur)[0])
+        self.assertEqual(mock_session.get.call_count, 1)
+
+        second = r.Round.from_rows("dummy2", [("1 house st", "A01"), ("2 House St", "A01")])
+        self.assertTrue(n.geocode_round(second, cur=cur)[0])
+        self.assertEqual(mock_session.get.call_count, 2)
+        self.assertListEqual(second.coords.tolist(), [[51.5, -0.1], [51.5, -0.1]])
+
+        cur.close()
+
+    @patch("nominatim.session", autospec=True)
+    def test_search_modes(self, mock_session):
+        """test structured searches fall back to free text when they find nothing"""
+        found = [{"lat": "51.5", "lon": "-0.1", "osm_type": "node", "osm_id": 2}]
+        mock_session.get.return_value.json.side_effect = [found]
+        self.assertEqual(n.search("1 House St", "A01", mode="structured"), found[0])
+        self.assertEqual(mock_session.get.call_args.kwargs["params"]["postalcode"], "A01")
+        self.assertNotIn("q", mock_session.get.call_args.kwargs["params"])
+
+        mock_session.get.return_value.json.side_effect = [[], found]
+        self.assertEqual(n.search("1 House St", "A01", mode="auto"), found[0])
+        self.assertEqual(mock_session.get.call_args.kwargs["params"]["q"], "1 House St A01")
+
+        mock_session.get.return_value.json.side_effect = [[]]
+        self.assertIsNone(n.search("1 House St", "A01", mode="structured"))
+
+        mock_session.get.return_value.json.side_effect = [found]
+        n.search("1 House St", "", mode="auto")
+        self.assertEqual(mock_session.get.call_args.kwargs["params"]["q"], "1 House St ")
+
+    @patch("nominatim.session", autospec=True)
+    def test_geocode_round_lookup(self, mock_session):
+        """test addresses with a known OSM id are geocoded together through /lookup"""
+        cur = self.con.cursor()
+        cur.execute("DELETE FROM meta.addresses;")
+        self.assertFalse(d.store_osm_id("1 House St", "A01", "123", cur)[0])
+        self.assertTrue(d.store_osm_id("1 House St", "A01", "W1", cur)[0])
+        self.assertTrue(d.store_osm_id("2 House St", "A01", "N2", cur)[0])
+        self.con.commit()
+
+        def get(url, params=None, timeout=None): # pylint: disable=unused-argument
+            response = MagicMock()
+            if url == n.LOOKUP_URL:
+                response.json.return_value = [
+                    {"lat": "51.5", "lon": "-0.1", "osm_type": "way", "osm_id": 1},
+                    {"lat": "51.6", "lon": "-0.2", "osm_type": "node", "osm_id": 2}]
+            else:
+                response.json.return_value = [{"lat": "51.7", "lon": "-0.3",
+                                               "osm_type": "relation", "osm_id": 3}]
+            return response
+        mock_session.get.side_effect = get
+
+        rnd = r.Round.from_rows("dummy1", [("1 House St", "A01"), ("2 house st", "a01"),
+                                           ("3 House St", "A01")])
+        self.assertTrue(n.geocode_round(rnd, cur=cur)[0])
+        self.assertEqual(mock_session.get.call_count, 2)
+        self.assertEqual(mock_session.get.call_args_list[0].kwargs["params"]["osm_ids"], "N2,W1")
+        self.assertListEqual(rnd.coords.tolist(), [[51.5, -0.1], [51.6, -0.2], [51.7, -0.3]])
+        self.assertListEqual(d.select_addresses([("3 House St", "A01")], cur), [(51.7, -0.3, "R3")])
+
+        #a new osm id clears the old geocode so it is looked up again
+        d.store_osm_id("1 House St", "A01", "W9", cur)
+        self.assertListEqual(d.select_addresses([("1 House St", "A01")], cur), [(None, None, "W9")])
+        cur.close()
+
+    def test_index_stops_sync(self):
+        """test the stop index follows the table through delete and rollback"""
+        cur = self.con.cursor()
+        sql_index = "SELECT street FROM meta.stops WHERE round='dummy' AND rb=0 ORDER BY street"
+
+        d.create_table("dummy", cur, self.con)
+        d.insert_value("dummy", "1 House St", "A01", cur, self.con)
+        d.insert_value("dummy", "2 House St", "A01", cur, self.con)
+        d.index_stops("dummy", [("1 House St", "A01", 51.5, -0.1),
+                                ("2 House St", "A01", "51.501", "-0.1")], cur)
+        self.con.commit()
+        self.assertListEqual(cur.execute(sql_index).fetchall(), [("1 House St",), ("2 House St",)])
+
+        d.delete_value("dummy", "2 House St", "A01", cur, self.con)
+        self.assertListEqual(cur.execute(sql_index).fetchall(), [("1 House St",)])
+
+        d.rollback_table("dummy", cur, self.con)
+        self.assertListEqual(cur.execute(sql_index).fetchall(), [("1 House St",), ("2 House St",)])
+
+        d.delete_table("dummy", cur, self.con)
+        self.assertListEqual(cur.execute(sql_index).fetchall(), [])
+
+        cur.close()
+
+    def test_create_rounds_routes(self):
+        """test rounds are created with their routes, and a bad trip leaves none of them"""
+        cur = self.con.cursor()
+        stops = [("1 House St", "A01", 51.5, -0.1), ("2 House St", "A01", 51.51, -0.1)]
+        trip = {"summary": {"time": 60}, "legs": [{"summary": {"time": 60}, "shape": "abc"}]}
+
+        with self.assertRaises(KeyError):
+            d.create_rounds([("dummy1", stops), ("dummy2", stops)], cur, self.con, [trip, {}])
+        self.assertNotIn("dummy1", d.get_all_tables(cur))
+        self.assertIsNone(d.select_route("dummy1", cur))
+
+        output = d.create_rounds([("dummy1", stops), ("dummy2", stops)], cur, self.con,
+                                 [trip, trip])
+        self.assertEqual(output[1], "Tables dummy1, dummy2 created")
+        self.assertDictEqual(d.select_route("dummy2", cur), trip)
+
+        d.delete_table("dummy1", cur, self.con)
+        d.delete_table("dummy2", cur, self.con)
+        cur.close()
+
+    def test_nearest_rounds(self):
+        """test nearest_rounds orders rounds by their closest stop"""
+        cur = self.con.cursor()
+
+        d.index_stops("dummy1", [("1 House St", "A01", 51.5, -0.1),
+                                 ("2 House St", "A01", 51.52, -0.1)], cur)
+        d.index_stops("dummy2", [("1 House Dr", "A02", 51.5003, -0.1003)], cur)
+        d.index_stops("dummy3", [("1 Far Rd", "A03", 53.0, -2.0)], cur)
+
+        #fewer rounds than the limit, so the search widens until it has all of them
+        output = d.nearest_rounds(51.5001, -0.1001, cur)
+        self.assertListEqual([r[0] for r in output], ["dummy1", "dummy2", "dummy3"])
+        output = d.nearest_rounds(51.5001, -0.1001, cur, limit=2)
+        self.assertListEqual([r[0] for r in output], ["dummy1", "dummy2"])
+
+        #nothing nearby so the search widens until the far round is found
+        output = d.nearest_rounds(53.5, -2.5, cur)
+        self.assertEqual(output[0][0], "dummy3")
+
+        cur.close()
+
+    def test_nearest_rounds_limit(self):
+        """test the limit is filled even when one round is much closer than the rest"""
+        cur = self.con.cursor()
+        d.index_stops("near", [("1 House St", "A01", 51.5, -0.1)], cur)
+        for i, lat in enumerate((51.5045, 51.509, 51.5135, 51.52)):
+            d.index_stops(f"far{i}", [(f"{i} Far Rd", "A02", lat, -0.1)], cur)
+
+        output = d.nearest_rounds(51.5, -0.1, cur)
+        self.assertListEqual([r[0] for r in output], ["near", "far0", "far1", "far2", "far3"])
+        cur.close()
+
+    def test_nearest_rounds_cell_edge(self):
+        """test a closer round just outside the first cells searched still comes first"""
+        cur = self.con.cursor()
+        lat_step, lon_step = spatial.cell_size(spatial.SEARCH_PRECISION)
+        lat = -90 + (math.floor((51.5 + 90) / lat_step) + 0.5) * lat_step #middle of its cell
+        lon = -180 + (math.floor((-0.1 + 180) / lon_step) + 0.95) * lon_step #near the east edge
+
+        #inside the searched 3x3 block to the west, but further than a stop just beyond it
+        d.index_stops("dummy1", [("1 House St", "A01", lat, lon - 1.9 * lon_step)], cur)
+        d.index_stops("dummy2", [("1 House Dr", "A02", lat, lon + 1.2 * lon_step)], cur)
+
+        output = d.nearest_rounds(lat, lon, cur)
+        self.assertListEqual([r[0] for r in output], ["dummy2", "dummy1"])
+        cur.close()
+
     def tearDown(self):
         """double check test tables wiped"""
         cur = self.con.cursor()
@@ -499,5 +1018,261 @@ class DatabaseTestCase(unittest.TestCase):
         cur.close()
         return super().tearDown()
 
+class RoundsTestCase(unittest.TestCase):
+    """Class for testing the Round representation in rounds.py"""
+
+    rows = [("1 House St", "A01"), ("2 House St", "A01"), ("3 House St", "A01")]
+
+    def test_apply_trip(self):
+        """test valhalla's original_index reorders every array of the round"""
+        rnd = r.Round.from_rows("dummy", self.rows)
+        rnd.apply_trip([
+            {"lat": 3.0, "lon": -3.0, "original_index": 2},
+            {"lat": 1.0, "lon": -1.0, "original_index": 0},
+            {"lat": 2.0, "lon": -2.0, "original_index": 1},
+        ])
+
+        self.assertListEqual(rnd.rows(), [("3 House St", "A01"), ("1 House St", "A01"),
+                                          ("2 House St", "A01")])
+        self.assertListEqual(rnd.stops(), [("3 House St", "A01", 3.0, -3.0),
+                                           ("1 House St", "A01", 1.0, -1.0),
+                                           ("2 House St", "A01", 2.0, -2.0)])
+        self.assertListEqual(rnd.locations(), [{"lat": 3.0, "lon": -3.0},
+                                               {"lat": 1.0, "lon": -1.0},
+                                               {"lat": 2.0, "lon": -2.0}])
+
+    def test_insertion_index(self):
+        """test a stop is inserted where it adds the least distance"""
+        rnd = r.Round.from_stops("dummy", [("1 House St", "A01", 51.50, -0.1),
+                                           ("2 House St", "A01", 51.52, -0.1),
+                                           ("3 House St", "A01", 51.54, -0.1)])
+        self.assertEqual(rnd.insertion_index(51.53, -0.1), 2)
+        rnd.insert(2, "4 House St", "A01", 51.53, -0.1)
+        self.assertListEqual([stop[0] for stop in rnd.stops()],
+                             ["1 House St", "2 House St", "4 House St", "3 House St"])
+
+    def test_partition(self):
+        """test stops are split into compact groups within their caps"""
+        coords = np.array([[51.50, -0.1], [52.00, -1.0], [51.51, -0.1],
+                           [52.01, -1.0], [51.52, -0.1], [52.02, -1.0]])
+
+        groups = r.partition(coords, [3, 3])
+        self.assertCountEqual([g.tolist() for g in groups], [[0, 2, 4], [1, 3, 5]])
+
+        groups = r.partition(coords, [4, 2])
+        self.assertListEqual([len(g) for g in groups], [4, 2])
+        self.assertListEqual(sorted(np.concatenate(groups).tolist()), list(range(6)))
+
+    def test_partition_min_size(self):
+        """test no group is left empty or with a lone stop"""
+        same = np.tile([51.5, -0.1], (4, 1))
+        self.assertListEqual([len(g) for g in r.partition(same, [4, 4])], [2, 2])
+
+        coords = np.array([[51.50, -0.1], [51.51, -0.1], [51.52, -0.1], [52.00, -1.0],
+                           [52.01, -1.0], [52.02, -1.0], [53.0, -2.0]])
+        groups = r.partition(coords, [3, 3, 3])
+        self.assertTrue(all(len(g) >= r.MIN_GROUP for g in groups))
+        self.assertListEqual(sorted(np.concatenate(groups).tolist()), list(range(7)))
+
+    def test_heuristic_order(self):
+        """test the heuristic visits nearest stops first and keeps the start and end"""
+        coords = np.array([[51.50, -0.1], [51.53, -0.1], [51.51, -0.1],
+                           [51.52, -0.1], [51.54, -0.1]])
+        self.assertListEqual(r.nearest_neighbour(coords).tolist(), [0, 2, 3, 1, 4])
+        self.assertListEqual(r.heuristic_order(coords, float("inf")).tolist(), [0, 2, 3, 1, 4])
+
+    def test_heuristic_small(self):
+        """test rounds too small to reorder come back as they are"""
+        self.assertEqual(r.distance_matrix(np.empty((0, 2))).shape, (0, 0))
+        self.assertListEqual(r.heuristic_order(np.empty((0, 2)), float("inf")).tolist(), [])
+        self.assertListEqual(r.heuristic_order(np.array([[51.5, -0.1]]), float("inf")).tolist(),
+                             [0])
+
+    def test_heuristic_deadline(self):
+        """test the heuristic keeps to its deadline however large the round"""
+        coords = np.array([[51.50, -0.1], [51.53, -0.1], [51.51, -0.1],
+                           [51.52, -0.1], [51.54, -0.1]])
+        self.assertListEqual(r.nearest_neighbour(coords, 0).tolist(), [0, 1, 2, 3, 4])
+
+        coords = np.random.default_rng(0).random((5000, 2)) + [51.0, -1.0]
+        start = time.monotonic()
+        order = r.heuristic_order(coords, start + 0.05)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertListEqual(sorted(order.tolist()), list(range(5000)))
+
+    def test_two_opt(self):
+        """test 2-opt untangles a stored order but keeps its start and end"""
+        position = np.array([0.0, 2.0, 1.0, 3.0, 4.0])
+        cost = np.abs(position[:, None] - position[None, :])
+
+        order = r.two_opt(cost, float("inf"))
+        self.assertListEqual(order.tolist(), [0, 2, 1, 3, 4])
+        self.assertLess(r.path_cost(cost, order), r.path_cost(cost, np.arange(5)))
+
+    def test_from_stops_empty(self):
+        """test a round can be built from a table with no stops"""
+        rnd = r.Round.from_stops("dummy", [])
+        self.assertEqual(len(rnd), 0)
+        self.assertEqual(rnd.coords.shape, (0, 2))
+
+class SchedulerTestCase(unittest.TestCase):
+    """Class for testing the background re-optimisation in scheduler.py"""
+
+    con = sqlite3.connect("test.db")
+    stops = [("1 House St", "A01", 51.50, -0.1), ("3 House St", "A01", 51.52, -0.1),
+             ("2 House St", "A01", 51.51, -0.1), ("4 House St", "A01", 51.53, -0.1)]
+
+    def setUp(self):
+        cur = self.con.cursor()
+        cur.executescript("DROP TABLE IF EXISTS dummy; DROP TABLE IF EXISTS dummy_rb")
+        d.create_table("dummy", cur, self.con)
+        for street, postcode, _, _ in self.stops:
+            d.insert_value("dummy", street, postcode, cur, self.con)
+        d.index_stops("dummy", self.stops, cur)
+        self.con.commit()
+        cur.close()
+
+    @patch("scheduler.v.cost_matrix")
+    def test_reoptimise(self, mock_matrix):
+        """test the stored order is improved using the cost matrix"""
+        lats = np.array([stop[2] for stop in self.stops])
+        mock_matrix.return_value = np.abs(lats[:, None] - lats[None, :])
+
+        output = s.reoptimise("dummy", 1.0, self.con, s.RateLimiter(), threading.Event())
+        self.assertEqual(output[1], "Table dummy reordered")
+
+        cur = self.con.cursor()
+        result_dummy = cur.execute("SELECT street FROM dummy ORDER BY id").fetchall()
+        self.assertListEqual(result_dummy, [("1 House St",), ("2 House St",),
+                                            ("3 House St",), ("4 House St",)])
+        cur.close()
+
+    @patch("valhalla.session", autospec=True)
+    def test_reoptimise_timeout(self, session):
+        """test a valhalla timeout is logged by the scheduler and leaves the round as it was"""
+        session.post.side_effect = requests.Timeout
+        cur = self.con.cursor()
+        cur.execute("DELETE FROM meta.queue;")
+        d.enqueue_round("dummy", s.EDITED, cur)
+        self.con.commit()
+
+        scheduler = s.Scheduler("test.db", idle_after=0)
+        with self.assertLogs("scheduler", level="ERROR"):
+            scheduler.start()
+            for _ in range(50):
+                if session.post.called:
+                    break
+                time.sleep(0.1)
+            scheduler.stop(5)
+        self.assertEqual(session.post.call_args.kwargs["timeout"], v.REQUEST_TIMEOUT)
+
+        result_dummy = cur.execute("SELECT street FROM dummy ORDER BY id").fetchall()
+        self.assertListEqual(result_dummy, [(stop[0],) for stop in self.stops])
+        cur.close()
+
+    def test_table_reorder_changed(self):
+        """test a reorder is refused when the table changed after it was read"""
+        cur = self.con.cursor()
+        expected = d.select_all("dummy", cur)
+        d.delete_value("dummy", "4 House St", "A01", cur, self.con)
+
+        output = d.table_reorder("dummy", expected, list(reversed(expected)), cur)
+        self.con.rollback()
+        self.assertEqual(output[1], "Table dummy changed since it was read")
+        cur.close()
+
+    def test_enqueue_priority(self):
+        """test edited rounds run before swept ones and a round is only queued once"""
+        cur = self.con.cursor()
+        cur.execute("DELETE FROM meta.queue;")
+        d.enqueue_round("swept", s.IDLE, cur)
+        d.enqueue_round("edited", s.IDLE, cur)
+        d.enqueue_round("edited", s.EDITED, cur)
+        d.enqueue_round("edited", s.IDLE, cur)
+        self.con.commit()
+        cur.close()
+
+        scheduler = s.Scheduler("test.db", idle_after=0)
+        self.assertEqual(scheduler.next_table(self.con), ("edited", s.EDITED))
+        self.assertEqual(scheduler.next_table(self.con), ("swept", s.IDLE))
+
+    @patch("main.serving", True)
+    @patch("main.DB_PATH", "test.db")
+    def test_shared_queue(self):
+        """test a round queued and activity recorded by a worker reach a scheduler in another"""
+        self.con.execute("DELETE FROM meta.queue;")
+        self.con.commit()
+        main.close_con()
+        client = main.create_app().test_client()
+        client.post("/delete_value", json={"table": "dummy", "defer": True,
+                                           "address": ("4 House St", "A01")})
+        self.assertLess(time.time() - s.last_activity("test.db"), 5)
+
+        other = sqlite3.connect("test.db") #the scheduler worker's own connection
+        d.attach_meta(other.cursor())
+        scheduler = s.Scheduler("test.db", idle_after=0)
+        self.assertEqual(scheduler.next_table(other), ("dummy", s.EDITED))
+        other.close()
+        main.close_con()
+
+    def tearDown(self):
+        cur = self.con.cursor()
+        cur.executescript("DROP TABLE IF EXISTS dummy; DROP TABLE IF EXISTS dummy_rb")
+        cur.close()
+        if os.path.exists(s.activity_path("test.db")):
+            os.remove(s.activity_path("test.db"))
+        return super().tearDown()
+
+class ProfilingTestCase(unittest.TestCase):
+    """Class for testing the opt-in request profiling in profiler.py"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        main.close_con() #reconnect so the connection picks up the profiling settings
+
+    def tearDown(self):
+        main.close_con()
+        cur = sqlite3.connect("test.db").cursor()
+        d.delete_table("profiled", cur, cur.connection)
+        cur.connection.close()
+        self.dir.cleanup()
+
+    def test_disabled(self):
+        """test nothing is profiled and connections stay plain with profiling off"""
+        self.assertIs(p.connection_factory(), sqlite3.Connection)
+        p.start("anything")
+        self.assertFalse(p.active())
+        self.assertIsNone(p.stop("request"))
+
+    @patch("nominatim.session", autospec=True)
+    @patch("main.DB_PATH", "test.db")
+    def test_profile_header(self, mock_session):
+        """test a request with the profile header writes a profile and its slowest queries"""
+        mock_session.get.return_value.json.return_value = [{"lat": "51.5", "lon": "-0.1",
+                                                             "osm_type": "way", "osm_id": 1}]
+        with patch("profiler.PROFILE_TOKEN", "secret"), \
+             patch("profiler.PROFILE_DIR", self.dir.name):
+            client = main.create_app().test_client()
+            client.post("/create_table", json={"table": "profiled"})
+            self.assertListEqual(os.listdir(self.dir.name), [])
+
+            response = client.post("/create_table", json={"table": "profiled"},
+                                   headers={p.PROFILE_HEADER: "wrong"})
+            self.assertListEqual(os.listdir(self.dir.name), [])
+            response = client.post("/insert_value", json={"table": "profiled", "defer": True,
+                                                          "address": ("1 House St", "A01")},
+                                   headers={p.PROFILE_HEADER: "secret"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.text, "Inserted values (1 House St, A01) into profiled")
+            self.assertFalse(p.active())
+
+        files = sorted(os.listdir(self.dir.name))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].endswith("insert_value.prof"))
+        pstats.Stats(os.path.join(self.dir.name, files[0])) #readable profile
+        with open(os.path.join(self.dir.name, files[1]), encoding="utf-8") as f:
+            log = f.read()
+        self.assertIn("INSERT INTO profiled", log)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,16 @@
 """Functions related to interacting with the Valhalla Engine should be put inside this module"""
 
+import os
+import numpy as np
 import requests
 
-ROUTE_URL = "http://localhost:8002/optimized_route"
+ROUTE_URL = os.environ.get("ROUTE_URL", "http://localhost:8002/optimized_route")
+DIRECTIONS_URL = os.environ.get("DIRECTIONS_URL", f"{ROUTE_URL.rsplit('/', 1)[0]}/route")
+MATRIX_URL = os.environ.get("MATRIX_URL", f"{ROUTE_URL.rsplit('/', 1)[0]}/sources_to_targets")
+STATUS_URL = f"{ROUTE_URL.rsplit('/', 1)[0]}/status"
+REQUEST_TIMEOUT = 30 #seconds, default wait for a matrix or route so a stalled valhalla can't hang
+
+session = requests.Session() #keep-alive connections to valhalla, see main.warm_up
 
 def optimise_adds(geocodes):
     """
@@ -11,6 +19,33 @@ def optimise_adds(geocodes):
     [ {"lat": float , "lon": float , "original_index": int}, ...]
     """
 
+    return optimise_trip(geocodes)['locations']
+
+def optimise_trip(geocodes, timeout=None):
+    """
+    take a list of dict in the format [ {lat: <GEOCODE_1>, lon: <GEOCODE_2>} ]
+    and returns valhalla's whole optimised trip, locations plus its legs and summary
+    raises requests.Timeout if valhalla takes longer than timeout seconds
+    """
+
+    payload = {
+    "locations": geocodes,
+    "costing": "auto",
+    "directions_options": {"units": "kilometers"}
+    }
+
+    headers = {"Content-Type": "application/json"}
+    response = session.post(ROUTE_URL, headers=headers, json=payload, timeout=timeout).json()
+
+    return response['trip']
+
+def route_trip(geocodes, timeout=REQUEST_TIMEOUT):
+    """
+    take a list of dict in the format [ {lat: <GEOCODE_1>, lon: <GEOCODE_2>} ]
+    and returns valhalla's trip visiting them in the given order, without reordering
+    raises requests.Timeout if valhalla takes longer than timeout seconds
+    """
+
     payload = {
     "locations": geocodes,
     "costing": "auto",
@@ -18,6 +53,26 @@ def optimise_adds(geocodes):
     }
 
     headers = {"Content-Type": "application/json"}
-    response = requests.post(ROUTE_URL, headers=headers, json=payload).json()
+    response = session.post(DIRECTIONS_URL, headers=headers, json=payload,
+                            timeout=timeout).json()
+
+    return response['trip']
+
+def cost_matrix(locations, timeout=REQUEST_TIMEOUT):
+    """
+    take a list of dict in the format [ {lat: float, lon: float} ]
+    and returns a numpy array of travel times where [i][j] is the time from locations i to j
+    raises requests.Timeout if valhalla takes longer than timeout seconds
+    """
+
+    payload = {
+    "sources": locations,
+    "targets": locations,
+    "costing": "auto"
+    }
+
+    headers = {"Content-Type": "application/json"}
+    response = session.post(MATRIX_URL, headers=headers, json=payload, timeout=timeout).json()
 
-    return response['trip']['locations']
+    return np.array([[cell["time"] for cell in row] for row in response['sources_to_targets']],
+                    dtype=float)
@@ -0,0 +1,4 @@
+"""WSGI entry point for production, run with: gunicorn -c gunicorn.conf.py wsgi:app
+configuration comes from the environment, see gunicorn.conf.py and the *_URL/DB_PATH constants"""
+
+from main import app # pylint: disable=unused-import